@@ -2,22 +2,225 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 import aiohttp
+import asyncio
 import io
+import json
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Replace 'YOUR_BOT_TOKEN' with your actual bot token
 TOKEN = 'YOUR_BOT_TOKEN'
 # Replace with the URL where your Flask API is running
-API_URL = "http://localhost:5000/generate_map"
+API_URL = "http://localhost:5000"
+JOB_POLL_INTERVAL = 2  # Seconds between job status checks
+JOB_TIMEOUT = 14 * 60  # Discord interaction tokens expire after 15 minutes
+
+# Embedded mode fetches and renders inside the bot process instead of calling the API at API_URL
+EMBEDDED = False
+RENDER_WORKERS = os.cpu_count() or 1  # Embedded mode render processes
+PROGRESS_INTERVAL = 2  # Seconds between progress edits of a command's response
+
+if EMBEDDED:
+    from plutonium import fetch as engine
+    from plutonium.render import render_png
+
+class MapError(Exception):
+    pass
+
+class MapRender:
+    # One render shared by every identical command in flight, each of which gets the progress edits
+    def __init__(self):
+        self.interactions = []
+        self.planned = 0
+        self.fetched = 0
+        self.last_report = 0
+        self.pending_report = None
+        self.task = None
+
+    async def report(self, text, force=False):
+        if not force and time.monotonic() - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = time.monotonic()
+        for interaction in list(self.interactions):
+            try:
+                await interaction.edit_original_response(content=text)
+            except discord.HTTPException:
+                pass  # One expired interaction must not fail the render for the others
+
+    def update(self, planned=0, done=0):
+        # Called as EarthMC batches are planned and arrive. At most one edit is pending at a time,
+        # updates that arrive meanwhile are shown by the next one
+        self.planned += planned
+        self.fetched += done
+        if self.planned and (self.pending_report is None or self.pending_report.done()):
+            self.pending_report = asyncio.ensure_future(self.report(f"Generating map: fetching ({50 * self.fetched // self.planned}%)"))
+            self.pending_report.add_done_callback(self.report_done)
+
+    @staticmethod
+    def report_done(task):
+        # Progress edits are best effort, anything else a background one raises is dropped without a warning
+        if not task.cancelled():
+            task.exception()
+
+class SharedFetch:
+    # Progress of one fetch, passed on to every render waiting for it; renders that join late catch up first
+    def __init__(self):
+        self.renders = []
+        self.planned = 0
+        self.fetched = 0
+
+    def add(self, render):
+        self.renders.append(render)
+        render.update(self.planned, self.fetched)
+
+    def update(self, planned=0, done=0):
+        self.planned += planned
+        self.fetched += done
+        for render in self.renders:
+            render.update(planned, done)
 
 class EarthMCBot(discord.Client):
     def __init__(self):
         super().__init__(intents=discord.Intents.default())
         self.tree = app_commands.CommandTree(self)
+        self.session = None
+        self.render_pool = None
+        self.renders = {}
+        self.fetches = {}
 
     async def setup_hook(self):
+        # One session for every command; in embedded mode the engine keeps its own for the EarthMC API
+        self.session = aiohttp.ClientSession()
+        if EMBEDDED:
+            self.render_pool = self.new_render_pool()
         await self.tree.sync()
 
+    def new_render_pool(self):
+        return ProcessPoolExecutor(RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+        if EMBEDDED:
+            await engine.api_client.close()
+            if self.render_pool is not None:
+                self.render_pool.shutdown(wait=False, cancel_futures=True)
+        await super().close()
+
+    async def generate(self, interaction, map_data):
+        # Identical commands in flight wait on the same render instead of starting their own
+        key = json.dumps(map_data, sort_keys=True)
+        render = self.renders.get(key)
+        if render is None:
+            render = self.renders[key] = MapRender()
+            render.task = asyncio.ensure_future(self.render_embedded(map_data, render) if EMBEDDED else self.render_remote(map_data, render))
+            render.task.add_done_callback(lambda _: self.renders.pop(key, None))
+        render.interactions.append(interaction)
+        try:
+            return await asyncio.shield(render.task)
+        finally:
+            render.interactions.remove(interaction)
+
+    async def api_error(self, response, default):
+        # The API's own errors carry a JSON message, a proxy's 502 or 504 need not be JSON at all
+        try:
+            message = (await response.json(content_type=None)).get('error')
+        except (aiohttp.ClientError, ValueError, AttributeError):
+            message = None
+        return MapError(message or default)
+
+    async def read_job(self, response, status=200):
+        # The status is checked before the body is read, an expired job's 404 is an error rather than a job
+        if response.status != status:
+            raise await self.api_error(response, f"The map API returned HTTP {response.status}.")
+        try:
+            job = await response.json(content_type=None)
+            job['status'], job['progress'], job['id']
+        except (aiohttp.ClientError, ValueError, TypeError, KeyError) as e:
+            raise MapError("The map API returned an unreadable job.") from e
+        return job
+
+    async def render_remote(self, map_data, render):
+        try:
+            return await self.run_job(map_data, render)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise MapError(f"Could not reach the map API: {e}") from e
+
+    async def run_job(self, map_data, render):
+        # The map renders as a job on the API, so no connection is held open while it runs
+        async with self.session.post(f"{API_URL}/jobs", json=map_data) as response:
+            job = await self.read_job(response, 202)
+
+        deadline = time.monotonic() + JOB_TIMEOUT
+        progress = None
+        while job['status'] in ('queued', 'fetching', 'rendering'):
+            if time.monotonic() > deadline:
+                async with self.session.delete(f"{API_URL}/jobs/{job['id']}"):
+                    pass
+                raise MapError("Map generation timed out.")
+            if job['progress'] != progress:
+                progress = job['progress']
+                await render.report(f"Generating map: {job['status']} ({progress}%)", force=True)
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            async with self.session.get(f"{API_URL}/jobs/{job['id']}") as response:
+                job = await self.read_job(response)
+
+        async with self.session.get(f"{API_URL}/jobs/{job['id']}/result") as response:
+            if response.status != 200:
+                raise await self.api_error(response, f"Map generation {job['status']}.")
+            return await response.read()
+
+    async def fetch_towns(self, nation_names, town_names, render):
+        # Fetches run on this event loop, sharing the engine's session and town cache between commands.
+        # Commands for the same towns in flight, say in different color modes, share one fetch
+        key = json.dumps([sorted(name.lower() for name in nation_names), sorted(name.lower() for name in town_names)])
+        if key not in self.fetches:
+            progress = SharedFetch()
+            task = asyncio.ensure_future(self.fetch_embedded(nation_names, town_names, progress))
+            task.add_done_callback(lambda _: self.fetches.pop(key, None))
+            self.fetches[key] = task, progress
+        task, progress = self.fetches[key]
+        progress.add(render)
+        return await asyncio.shield(task)
+
+    async def fetch_embedded(self, nation_names, town_names, progress):
+        engine.fetch_progress.set(progress)
+        try:
+            if nation_names:
+                town_names = engine.unique_names(await engine.fetch_nation_towns(nation_names) + town_names)
+            if not town_names:
+                raise MapError("No valid town names found.")
+            table = await engine.fetch_town_data(town_names)
+        except engine.EarthMCAPIError as e:
+            raise MapError(f"EarthMC API request failed: {e}") from e
+        if not table:
+            raise MapError("No valid town data found.")
+        return table
+
+    async def render_embedded(self, map_data, render):
+        # Rendering runs in the process pool so the event loop keeps serving other commands
+        table = await self.fetch_towns(engine.split_names(map_data.get('nation_names', '')),
+                                       engine.split_names(map_data.get('town_names', '')), render)
+
+        await render.report("Generating map: rendering (50%)", force=True)
+        pool = self.render_pool
+        try:
+            image, _ = await asyncio.get_running_loop().run_in_executor(
+                pool, render_png, table, map_data.get('show_home_blocks', True), map_data.get('color_mode', 'random'),
+                map_data['star_size'], 'imshow', False, None, {'image_format': map_data['format']})
+        except ValueError as e:
+            raise MapError(str(e)) from e
+        except BrokenProcessPool as e:
+            # A render process died, say killed for memory; the first render to notice replaces the pool
+            if self.render_pool is pool:
+                self.render_pool = self.new_render_pool()
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise MapError("The render process crashed, please try again.") from e
+        return image
+
 client = EarthMCBot()
 
 @client.tree.command(name="generate_map", description="Generate an EarthMC map")
@@ -28,7 +231,8 @@ client = EarthMCBot()
     town_names="Comma-separated list of town names (optional)",
     show_home_blocks="Show home blocks on the map",
     color_mode="Color mode for the map",
-    star_size="Size of the home block stars"
+    star_size="Size of the home block stars",
+    image_format="Image format, WebP is the smallest upload"
 )
 @app_commands.choices(color_mode=[
     app_commands.Choice(name="No Colors", value="no_colors"),
@@ -40,7 +244,16 @@ client = EarthMCBot()
     app_commands.Choice(name="Overclaimable", value="Overclaimable"),
     app_commands.Choice(name="Population Density", value="Population Density"),
     app_commands.Choice(name="Snipeable", value="Snipeable"),
-    app_commands.Choice(name="Mayor Last Online", value="Days Since Last Online")
+    app_commands.Choice(name="Mayor Last Online", value="Days Since Last Online"),
+    app_commands.Choice(name="Claim Compactness", value="Compactness"),
+    app_commands.Choice(name="Frontier Blocks", value="Frontier"),
+    app_commands.Choice(name="Foreign Border Length", value="Foreign Border"),
+    app_commands.Choice(name="Enclaves", value="Enclaves"),
+    app_commands.Choice(name="Nearest Town Distance", value="Nearest Town")
+], image_format=[
+    app_commands.Choice(name="PNG", value="png"),
+    app_commands.Choice(name="WebP", value="webp"),
+    app_commands.Choice(name="JPEG", value="jpeg")
 ])
 async def generate_map(
     interaction: discord.Interaction,
@@ -48,7 +261,8 @@ async def generate_map(
     town_names: str = "",
     show_home_blocks: bool = True,
     color_mode: str = "random",
-    star_size: int = 250
+    star_size: int = 250,
+    image_format: str = "png"
 ):
     # Prepare request body
     map_data = {}
@@ -63,22 +277,23 @@ async def generate_map(
     if color_mode:
         map_data['color_mode'] = color_mode
     map_data['star_size'] = star_size
+    map_data['format'] = image_format
 
     await interaction.response.defer()
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(API_URL, json=map_data) as response:
-            if response.status == 200:
-                image_data = await response.read()
-                file = discord.File(io.BytesIO(image_data), filename="earthmc_map.png")
-                await interaction.followup.send(file=file)
-            else:
-                error_message = await response.text()
-                await interaction.followup.send(f"Error generating map: {error_message}")
+    try:
+        image_data = await client.generate(interaction, map_data)
+    except MapError as e:
+        await interaction.edit_original_response(content=f"Error generating map: {e}")
+        return
+
+    file = discord.File(io.BytesIO(image_data), filename=f"earthmc_map.{image_format}")
+    await interaction.edit_original_response(content=None, attachments=[file])
 
 @client.event
 async def on_ready():
     print(f'Logged in as {client.user} (ID: {client.user.id})')
     print('------')
 
-client.run(TOKEN)
+if __name__ == '__main__':
+    client.run(TOKEN)
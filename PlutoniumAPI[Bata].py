@@ -1,241 +1,896 @@
 import io
-import base64
+import math
+import re
+import hashlib
+import sys
 import threading
-import requests
+import asyncio
 import json
-import matplotlib.pyplot as plt
-from matplotlib.figure import Figure
 import numpy as np
-import random
-import matplotlib.colors as mcolors
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import Image
+from itertools import chain
 import time
-from flask import Flask, request, jsonify, send_file
+
+import heapq
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, g, request, jsonify, send_file
+
+from plutonium.data import (CLAIM_CHANGES, BlockIndex, HistoryStore, TTLCache, TownTable, changed_towns, load_snapshot,
+                            read_snapshot_meta, save_snapshot)
+from plutonium.fetch import (MAX_QUERY_SIZE, EarthMCAPIError, api_client, batch_requests, cache_stats, fetch_all_town_names,
+                             fetch_player_data, fetch_progress, fetch_town_batch, get_nation_towns, get_town_data,
+                             name_resolution_stats, nation_cache, player_cache, run_sync, split_names, town_cache, unique_names)
+from plutonium.metrics import format_timings, metrics, request_timings
+from plutonium.render import (ANALYTICS_MODES, IMAGE_QUALITY, MAX_MAP_PIXELS, OUTPUT_FORMATS, PNG_COMPRESSION, analytics_values,
+                              build_palette, downsample_max, encode_image, index_palette, rasterize_towns, render_png, town_colors)
 
 app = Flask(__name__)
 
-API_NATIONS = "https://api.earthmc.net/v3/aurora/nations"
-API_TOWNS = "https://api.earthmc.net/v3/aurora/towns"
-API_PLAYERS = "https://api.earthmc.net/v3/aurora/players"
-
-def generate_color():
-    return mcolors.to_hex(mcolors.hsv_to_rgb((random.random(), 0.7, 0.9)))
-
-def gentownsmap(towns, show_home_blocks=True, color_mode='random', star_size=250):
-    fig = Figure(figsize=(10, 10), facecolor='#1e1e1e')
-    ax = fig.add_subplot(111)
-    ax.set_facecolor('#1e1e1e')
-
-    all_x = []
-    all_y = []
-    for town in towns:
-        town_blocks = town['coordinates']['townBlocks']
-        x_vals, y_vals = zip(*town_blocks)
-        all_x.extend(x_vals)
-        all_y.extend(y_vals)
-
-    min_x, max_x = min(all_x), max(all_x)
-    min_y, max_y = min(all_y), max(all_y)
-
-    grid_width = max_x - min_x + 1
-    grid_height = max_y - min_y + 1
-
-    grid = np.zeros((grid_height, grid_width))
-    colors = []
-
-    if color_mode != 'random' and color_mode != 'Overclaimable' and color_mode != 'No Colors' and color_mode != 'Snipeable':
-        if color_mode == 'Population Density':
-            stat_values = [town['stats']['numResidents'] / max(town['stats']['numTownBlocks'], 1) for town in towns]
-        elif color_mode == 'Days Since Last Online':
-            current_time = int(time.time() * 1000)  # Current time in milliseconds
-            stat_values = [(current_time - town['mayor_last_online']) / (24 * 60 * 60 * 1000) for town in towns]
-        else:
-            stat_values = [town['stats'][color_mode] for town in towns]
-        log_stat_values = np.log1p(stat_values)
-        min_stat, max_stat = min(log_stat_values), max(log_stat_values)
-
-    current_time = int(time.time() * 1000)  # Current time in milliseconds
-    ten_days_ms = 28 * 24 * 60 * 60 * 1000  # 10 days in milliseconds
-
-    for town in towns:
-        if color_mode == 'No Colors':
-            color = '#ffffff'
-        elif color_mode == 'random':
-            color = generate_color()
-        elif color_mode == 'Overclaimable':
-            if town['status']['isOverClaimed'] and not town['status']['hasOverclaimShield']:
-                color = 'red'
-            else:
-                color = 'grey'
-        elif color_mode == 'Snipeable':
-            if (town['stats']['numResidents'] == 1 and 
-                town['status']['isOpen'] and 
-                'mayor_last_online' in town and 
-                current_time - town['mayor_last_online'] > ten_days_ms):
-                color = 'yellow'
-            else:
-                color = 'grey'
-        elif color_mode == 'Days Since Last Online':
-            days_since_last_online = (current_time - town['mayor_last_online']) / (24 * 60 * 60 * 1000)
-            log_stat_value = np.log1p(days_since_last_online)
-            color_value = (log_stat_value - min_stat) / (max_stat - min_stat)
-            color = plt.cm.viridis(color_value)
+SNAPSHOT_DIR = 'snapshots'
+
+WORLD_REFRESH_INTERVAL = 600  # Seconds between background refreshes of every Aurora town, 0 disables them
+WORLD_MAX_AGE = 1800  # Older world data is ignored and maps are fetched live instead
+WORLD_PLAYER_REFRESH_EVERY = 6  # Re-check every mayor's lastOnline on every Nth refresh, otherwise only changed towns
+WORLD_SNAPSHOT = 'world'  # Snapshot the world is saved to after each refresh and loaded from at startup, None disables
+
+HISTORY_DIR = 'history'  # Where world history is kept for Claim Changes maps, None disables
+HISTORY_INTERVAL = 3600  # Seconds between history entries
+
+PROFILE_SLOW_REQUESTS = None  # Seconds; requests slower than this save a sampled stack profile, None disables
+PROFILE_INTERVAL = 0.005  # Seconds between stack samples
+PROFILE_DIR = 'profiles'
+
+TILE_SIZE = 256
+TILE_MAX_ZOOM_IN = 3  # Zoom levels past one pixel per town block
+TILE_CACHE_TTL = 300  # Seconds
+TILE_CACHE_SIZE = 4096
+
+MAP_CACHE_TTL = 60  # Seconds a rendered map is served without re-rendering
+MAP_CACHE_SIZE = 64
+
+RENDER_WORKERS = os.cpu_count() or 1  # Render processes, each renders one map at a time
+RENDER_QUEUE_SIZE = 32  # Renders allowed to wait for a free worker before answering 503
+RENDER_RETRY_AFTER = 5  # Seconds
+
+JOB_WORKERS = RENDER_WORKERS  # Threads running queued jobs; their renders share the render pool
+JOB_QUEUE_SIZE = 64  # Jobs allowed to wait before POST /jobs answers 503
+JOB_RESULT_TTL = 600  # Seconds a finished job and its result are kept
+JOB_FETCH_SHARE = 50  # Percent of a job's progress that fetching accounts for, rendering gets the rest
+JOB_TOWNS_PER_NATION = 20  # Size estimate for job priorities while no world state is loaded
+
+class MapRequestError(Exception):
+    def __init__(self, message, status=400, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+map_cache = TTLCache(MAP_CACHE_TTL, MAP_CACHE_SIZE)
+map_renders = {}
+map_renders_lock = threading.Lock()
+
+render_pool = None
+render_pool_lock = threading.Lock()
+render_slots = threading.BoundedSemaphore(RENDER_WORKERS + RENDER_QUEUE_SIZE)
+
+def get_render_pool():
+    # Spawned rather than forked: the parent already runs the fetch loop thread
+    global render_pool
+    with render_pool_lock:
+        if render_pool is None:
+            render_pool = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return render_pool
+
+def replace_render_pool(broken):
+    # A dead worker breaks the whole pool; only the first caller to notice swaps in a new one
+    global render_pool
+    with render_pool_lock:
+        if render_pool is broken:
+            render_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def submit_render(table, *options, wait=False):
+    # With wait the caller blocks for a free render slot instead of getting a 503, as queued jobs do
+    if not render_slots.acquire(blocking=wait):
+        raise MapRequestError("The render queue is full, please try again shortly.", 503, retry_after=RENDER_RETRY_AFTER)
+    pool = get_render_pool()
+    try:
+        try:
+            future = pool.submit(render_png, table, *options)
+        except Exception:
+            render_slots.release()
+            raise
+        future.add_done_callback(lambda _: render_slots.release())
+        image, timings = future.result()
+    except BrokenProcessPool:
+        # Killed or out of memory; later renders get a fresh pool
+        replace_render_pool(pool)
+        raise MapRequestError("A render worker stopped, please try again shortly.", 503, retry_after=RENDER_RETRY_AFTER)
+    for name, labels, seconds in timings:
+        metrics.observe(name, seconds, **labels)
+    metrics.count('towns_rendered', len(table))
+    metrics.count('blocks_rendered', len(table.blocks))
+    return image
+
+loaded_snapshots = {}
+loaded_snapshots_lock = threading.Lock()
+
+def snapshot_path(name):
+    if not re.fullmatch(r'\w[\w.-]*', name or '') or name.endswith('.tmp'):
+        raise MapRequestError(f"Invalid snapshot name '{name}'.")
+    return os.path.join(SNAPSHOT_DIR, name)
+
+def open_snapshot(name):
+    path = snapshot_path(name)
+    try:
+        created = read_snapshot_meta(path)['created']
+    except FileNotFoundError:
+        raise MapRequestError(f"Snapshot '{name}' not found.", 404)
+
+    # Reloaded only when the snapshot on disk has been replaced
+    with loaded_snapshots_lock:
+        loaded = loaded_snapshots.get(name)
+        if loaded is None or loaded[0] != created:
+            loaded = loaded_snapshots[name] = (created, load_snapshot(path))
+    return loaded[1]
+
+class WorldState:
+    def __init__(self, table, updated, changed=0, refresh_seconds=0.0):
+        self.table = table
+        self.updated = updated
+        self.changed = changed
+        self.refresh_seconds = refresh_seconds
+
+    def stats(self):
+        return {'towns': len(self.table), 'blocks': len(self.table.blocks), 'updated': self.updated,
+                'age_seconds': time.time() - self.updated, 'changed': self.changed, 'refresh_seconds': self.refresh_seconds}
+
+# Replaced as a whole by each refresh, so readers always see one consistent world
+world_state = None
+world_refreshes = 0
+
+history_store = None
+history_store_lock = threading.Lock()
+
+def get_history_store():
+    # Opened on first use, so render processes that re-import this script never read the history index
+    global history_store
+    with history_store_lock:
+        if history_store is None and HISTORY_DIR:
+            history_store = HistoryStore(HISTORY_DIR)
+        return history_store
+
+async def fetch_world(previous, refresh_players):
+    town_names = await fetch_all_town_names()
+    batches = await asyncio.gather(*(fetch_town_batch(batch) for batch in batch_requests(town_names)))
+    fetched = TownTable.from_json(list(chain.from_iterable(batches)))
+
+    if previous is None or refresh_players:
+        changed = np.ones(len(fetched), dtype=bool)
+        previous_rows = np.empty(0, dtype=np.int64)
+    else:
+        changed, previous_indices = changed_towns(fetched, previous)
+        previous_rows = previous_indices[~changed]
+
+    # Unchanged towns keep their previous row, including the mayor lastOnline, so only changed towns cost player lookups
+    updated = fetched.filter(changed)
+    mayor_data = await fetch_player_data(list(set(updated.mayors)))
+    updated.set_mayor_last_online({name: player['timestamps']['lastOnline'] for name, player in mayor_data.items()})
+
+    table = TownTable.concat([previous.take(previous_rows), updated]) if len(previous_rows) else updated
+    return table, int(changed.sum())
+
+def refresh_world():
+    global world_state, world_refreshes
+    start = time.perf_counter()
+    previous = world_state.table if world_state is not None else None
+    refresh_players = world_refreshes % WORLD_PLAYER_REFRESH_EVERY == 0
+
+    table, changed = run_sync(fetch_world(previous, refresh_players))
+    world_state = WorldState(table, time.time(), changed, time.perf_counter() - start)
+    world_refreshes += 1
+
+    if WORLD_SNAPSHOT:
+        save_snapshot(table, snapshot_path(WORLD_SNAPSHOT))
+    history = get_history_store()
+    if history is not None and (not history.entries or time.time() - history.entries[-1]['timestamp'] >= HISTORY_INTERVAL):
+        history.append(table)
+
+def world_refresh_loop():
+    global world_state
+    if WORLD_SNAPSHOT and world_state is None:
+        try:
+            path = snapshot_path(WORLD_SNAPSHOT)
+            world_state = WorldState(load_snapshot(path, mmap=False), read_snapshot_meta(path)['created'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    while True:
+        try:
+            refresh_world()
+        except (EarthMCAPIError, OSError) as e:
+            app.logger.warning("World refresh failed: %s", e)
+        except Exception:
+            # Say a malformed record or the clock moving back; the next refresh may well succeed
+            app.logger.exception("World refresh failed")
+        time.sleep(WORLD_REFRESH_INTERVAL)
+
+world_refresh_thread = None
+world_refresh_lock = threading.Lock()
+
+def start_world_refresh():
+    # Started by the first request, so it runs in whichever process serves them: the debug reloader's child or
+    # each WSGI worker, never the reloader's parent or a render process
+    global world_refresh_thread
+    with world_refresh_lock:
+        if world_refresh_thread is None and WORLD_REFRESH_INTERVAL > 0:
+            world_refresh_thread = threading.Thread(target=world_refresh_loop, name='world-refresh', daemon=True)
+            world_refresh_thread.start()
+
+class TilePyramid:
+    def __init__(self, world):
+        self.world = world
+        self.grid, (self.min_x, self.min_y, self.max_x, self.max_y) = rasterize_towns(world.table)
+        # At base_zoom one tile pixel is one town block; zoom 0 fits the whole grid into a single tile
+        self.base_zoom = max(0, math.ceil(math.log2(max(self.grid.shape) / TILE_SIZE)))
+        self.max_zoom = self.base_zoom + TILE_MAX_ZOOM_IN
+        self.palettes = {}
+        self.lock = threading.Lock()
+
+    def palette(self, color_mode):
+        # One palette per color mode and refresh, so 'random' colors match across tiles; index_palette's
+        # 8-bit version of it, when there is one, makes the tiles indexed PNGs
+        with self.lock:
+            if color_mode not in self.palettes:
+                palette = build_palette(town_colors(self.world.table, color_mode))
+                self.palettes[color_mode] = palette, index_palette(palette)
+            return self.palettes[color_mode]
+
+    def index_tile(self, z, x, y):
+        if not (0 <= z <= self.max_zoom and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return None
+
+        if z <= self.base_zoom:
+            scale = 2 ** (self.base_zoom - z)
+            span = TILE_SIZE * scale
+            cells = downsample_max(self.grid[y * span:(y + 1) * span, x * span:(x + 1) * span], scale)
         else:
-            if color_mode == 'Population Density':
-                stat_value = town['stats']['numResidents'] / max(town['stats']['numTownBlocks'], 1)
-            else:
-                stat_value = town['stats'][color_mode]
-            log_stat_value = np.log1p(stat_value)
-            color_value = (log_stat_value - min_stat) / (max_stat - min_stat)
-            color = plt.cm.viridis(color_value)
-
-        colors.append(color)
-        town_blocks = town['coordinates']['townBlocks']
-        for x, y in town_blocks:
-            grid[y - min_y, x - min_x] = len(colors)
-
-    cmap = mcolors.ListedColormap(['#1e1e1e'] + colors)
-    bounds = np.arange(len(colors) + 2) - 0.5
-    norm = mcolors.BoundaryNorm(bounds, cmap.N)
-
-    ax.clear() 
-    c = ax.pcolormesh(np.arange(min_x, max_x + 2), np.arange(min_y, max_y + 2), grid, cmap=cmap, norm=norm, shading='auto')
-
-    if show_home_blocks:
-        for town in towns:
-            home_block = town['coordinates']['homeBlock']
-            ax.scatter(home_block[0], home_block[1], c='#4CAF50', marker='*', s=star_size, edgecolor='white', zorder=5)
-
-    ax.set_aspect('equal')
-    ax.axis('off')
-
-    for spine in ax.spines.values():
-        spine.set_visible(False)
-
-    ax.set_title("", fontsize=16, fontweight='bold', color='#ffffff')
-    ax.invert_yaxis()
-
-    fig.tight_layout()
-
-    return fig
-
-def batch_requests(data_list, batch_size=100):
-    for i in range(0, len(data_list), batch_size):
-        yield data_list[i:i + batch_size]
-
-def get_nation_towns(nation_names):
-    headers = {"Content-Type": "application/json"}
-    nations = [name.strip() for name in nation_names.split(',')]
-
-    all_town_names = []
-    
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_batch = {executor.submit(fetch_nation_batch, batch): batch for batch in batch_requests(nations, batch_size=100)}
-        for future in as_completed(future_to_batch):
-            all_town_names.extend(future.result())
-
-    return all_town_names
-
-def fetch_nation_batch(nation_batch):
-    headers = {"Content-Type": "application/json"}
-    content = {"query": nation_batch}
-    response = requests.post(API_NATIONS, json=content, headers=headers)
-    town_names = []
-    if response.status_code == 200:
-        nation_data = response.json()
-        if nation_data:
-            for nation in nation_data:
-                town_names.extend([town['name'] for town in nation['towns']])
-    return town_names
-
-def get_town_data(town_names):
-    headers = {"Content-Type": "application/json"}
-    
-    all_town_data = []
-
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_batch = {executor.submit(fetch_town_batch, batch): batch for batch in batch_requests(town_names, batch_size=100)}
-        for future in as_completed(future_to_batch):
-            all_town_data.extend(future.result())
-
-    # Fetch mayor data for all towns
-    mayor_names = [town['mayor']['name'] for town in all_town_data]
-    mayor_data = get_player_data(mayor_names)
-
-    # Add mayor last online timestamp to town data
-    for town in all_town_data:
-        mayor_name = town['mayor']['name']
-        if mayor_name in mayor_data:
-            town['mayor_last_online'] = mayor_data[mayor_name]['timestamps']['lastOnline']
-
-    return all_town_data
-
-def fetch_town_batch(town_batch):
-    headers = {"Content-Type": "application/json"}
-    content = {"query": town_batch}
-    response = requests.post(API_TOWNS, json=content, headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    return []
-
-def get_player_data(player_names):
-    headers = {"Content-Type": "application/json"}
-    
-    all_player_data = {}
-
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        future_to_batch = {executor.submit(fetch_player_batch, batch): batch for batch in batch_requests(player_names, batch_size=100)}
-        for future in as_completed(future_to_batch):
-            all_player_data.update(future.result())
-
-    return all_player_data
-
-def fetch_player_batch(player_batch):
-    headers = {"Content-Type": "application/json"}
-    content = {"query": player_batch}
-    response = requests.post(API_PLAYERS, json=content, headers=headers)
-    player_data = {}
-    if response.status_code == 200:
-        data = response.json()
-        for player in data:
-            player_data[player['name']] = player
-    return player_data
+            factor = 2 ** (z - self.base_zoom)
+            span = TILE_SIZE // factor
+            cells = self.grid[y * span:(y + 1) * span, x * span:(x + 1) * span].repeat(factor, axis=0).repeat(factor, axis=1)
+
+        tile = np.zeros((TILE_SIZE, TILE_SIZE), dtype=self.grid.dtype)
+        tile[:cells.shape[0], :cells.shape[1]] = cells
+        return tile
+
+    def render_tile(self, z, x, y, color_mode):
+        tile = self.index_tile(z, x, y)
+        if tile is None:
+            return None
+
+        palette, indexed = self.palette(color_mode)
+        if indexed is None:
+            return encode_image(Image.fromarray(palette[tile]))
+        image = Image.fromarray(indexed[0][tile])
+        image.putpalette(indexed[1][:, :3].tobytes())
+        return encode_image(image)
+
+    def info(self):
+        return {'tile_size': TILE_SIZE, 'min_zoom': 0, 'max_zoom': self.max_zoom, 'base_zoom': self.base_zoom,
+                'origin': [self.min_x, self.min_y], 'blocks_per_tile_at_zoom_0': TILE_SIZE * 2 ** self.base_zoom,
+                'updated': self.world.updated}
+
+tile_pyramid = None
+tile_pyramid_lock = threading.Lock()
+tile_cache = TTLCache(TILE_CACHE_TTL, TILE_CACHE_SIZE)
+
+def get_tile_pyramid():
+    # Rasterized once per world refresh, on the first tile request that sees the new world
+    global tile_pyramid
+    world = world_state
+    if world is None:
+        return None
+    with tile_pyramid_lock:
+        if tile_pyramid is None or tile_pyramid.world is not world:
+            tile_pyramid = TilePyramid(world)
+        return tile_pyramid
+
+world_block_index = None
+world_block_index_lock = threading.Lock()
+
+def get_block_index():
+    global world_block_index
+    world = world_state
+    if world is None:
+        return None
+    with world_block_index_lock:
+        if world_block_index is None or world_block_index.table is not world.table:
+            world_block_index = BlockIndex(world.table)
+        return world_block_index
+
+def map_source(snapshot=None):
+    # The snapshot, or the world while it is fresh, that maps select their towns from; None when they are fetched live
+    world = world_state
+    if snapshot:
+        return open_snapshot(snapshot)
+    if world is not None and time.time() - world.updated < WORLD_MAX_AGE:
+        return world.table
+    return None
+
+def load_map_towns(nation_names, town_names, source=None):
+    if source is not None:
+        town_data = source.select(nation_names, town_names)
+    else:
+        try:
+            nation_towns = get_nation_towns(','.join(nation_names)) if nation_names else []
+            all_town_names = unique_names(nation_towns + town_names)
+
+            if not all_town_names:
+                raise MapRequestError("No valid town names found.")
+
+            town_data = get_town_data(all_town_names)
+        except EarthMCAPIError as e:
+            raise MapRequestError(f"EarthMC API request failed: {e}", 502) from e
+
+    if not town_data:
+        raise MapRequestError("No valid town data found.")
+
+    return town_data
+
+def town_analytics(nation_names, town_names, snapshot=None):
+    # Worked out over the whole world or snapshot, so borders and enclaves count the towns around the ones
+    # asked about; only a live fetch, without world state, is limited to the requested towns
+    from plutonium.analytics import analyze
+
+    table, scope = map_source(snapshot), 'snapshot' if snapshot else 'world'
+    if table is None:
+        table, scope = load_map_towns(nation_names, town_names), 'towns'
+
+    towns = np.flatnonzero(table.nation_mask(nation_names) | table.name_mask(town_names))
+    if not len(towns):
+        raise MapRequestError("No valid town data found.")
+
+    analytics = analyze(table)
+    nation_codes = set(int(code) for code in table.nation_codes[towns] if code >= 0)
+    return {"scope": scope, "towns": [analytics.town_stats(town) for town in towns],
+            "nation_borders": analytics.nation_borders(nation_codes), "enclaves": analytics.enclaves(towns)}
+
+def load_history_table(timestamp):
+    history = get_history_store()
+    if history is None:
+        raise MapRequestError("History is not enabled on this server.", 404)
+    table = history.load(timestamp)
+    if table is None:
+        raise MapRequestError(f"No history at or before {timestamp}.", 404)
+    return table
+
+def load_render_towns(nation_names, town_names, color_mode, snapshot=None, since=None, until=None):
+    # Analytics color modes are worked out over the whole world, snapshot or history entry the towns come from, as
+    # /analytics is, and passed to the render as values; only live fetches leave them to the render's own towns
+    baseline = None
+    if color_mode == CLAIM_CHANGES:
+        if since is None:
+            raise MapRequestError(f"The '{CLAIM_CHANGES}' color mode needs a 'since' timestamp.")
+        baseline = load_history_table(since).select(nation_names, town_names)
+
+    with metrics.span('load_towns'):
+        source = load_history_table(until) if until is not None else map_source(snapshot)
+        town_data = load_map_towns(nation_names, town_names, source)
+
+    values = None
+    if source is not None and (color_mode == 'Enclaves' or color_mode in ANALYTICS_MODES):
+        towns = np.flatnonzero(source.nation_mask(nation_names) | source.name_mask(town_names))
+        values = analytics_values(source, color_mode, towns)
+    return town_data, baseline, values
+
+def render_towns(town_data, baseline, values, show_home_blocks, color_mode, star_size, renderer, crop_clusters=False, encoding=None,
+                 wait=False):
+    try:
+        return submit_render(town_data, show_home_blocks, color_mode, star_size, renderer, crop_clusters, baseline, encoding, values,
+                             wait=wait)
+    except ValueError as e:
+        raise MapRequestError(str(e)) from e
+
+def render_map_png(nation_names, town_names, show_home_blocks, color_mode, star_size, renderer, snapshot=None, crop_clusters=False,
+                   since=None, until=None, encoding=None):
+    town_data, baseline, values = load_render_towns(nation_names, town_names, color_mode, snapshot, since, until)
+    return render_towns(town_data, baseline, values, show_home_blocks, color_mode, star_size, renderer, crop_clusters, encoding)
+
+def parse_map_request(data):
+    # The /generate_map and /jobs body as render_map_png's keyword arguments; raises MapRequestError when invalid
+    options = {
+        'nation_names': split_names(data.get('nation_names', '')),
+        'town_names': split_names(data.get('town_names', '')),
+        'show_home_blocks': bool(data.get('show_home_blocks', True)),
+        'color_mode': data.get('color_mode', 'random'),
+        'star_size': data.get('star_size', 250),
+        'renderer': data.get('renderer', 'imshow'),
+        'snapshot': data.get('snapshot'),
+        'crop_clusters': bool(data.get('crop_clusters', False)),
+    }
+    try:
+        options['since'], options['until'] = (None if data.get(key) is None else float(data[key]) for key in ('since', 'until'))
+    except (TypeError, ValueError):
+        raise MapRequestError("since and until must be unix timestamps.")
+
+    image_format = data.get('format', 'png')
+    if image_format not in OUTPUT_FORMATS:
+        raise MapRequestError(f"format must be one of: {', '.join(OUTPUT_FORMATS)}.")
+    try:
+        dpi = None if data.get('dpi') is None else float(data['dpi'])
+        max_pixels = min(int(data.get('max_pixels') or MAX_MAP_PIXELS), MAX_MAP_PIXELS)
+        compression = int(data.get('compression', PNG_COMPRESSION))
+        quality = int(data.get('quality', IMAGE_QUALITY))
+    except (TypeError, ValueError):
+        raise MapRequestError("dpi, max_pixels, compression and quality must be numbers.")
+    if (dpi is not None and dpi <= 0) or max_pixels <= 0 or not 0 <= compression <= 9 or not 1 <= quality <= 100:
+        raise MapRequestError("dpi and max_pixels must be positive, compression 0-9 and quality 1-100.")
+    options['encoding'] = {'image_format': image_format, 'dpi': dpi, 'max_pixels': max_pixels, 'compression': compression, 'quality': quality}
+
+    if not options['nation_names'] and not options['town_names']:
+        raise MapRequestError("Please provide either nation names or individual town names.")
+    return options
+
+def map_request_key(options):
+    return json.dumps([sorted(name.lower() for name in value) if key in ('nation_names', 'town_names') else value
+                       for key, value in options.items()])
+
+def get_or_render(key, render):
+    # Identical requests share one render: later arrivals wait on the first one's Future
+    cached = map_cache.get(key)
+    if cached is not None:
+        return cached
+
+    with map_renders_lock:
+        future = map_renders.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = map_renders[key] = Future()
+
+    if not is_owner:
+        return future.result()
+
+    try:
+        image = render()
+        result = (image, hashlib.sha1(image).hexdigest())
+        map_cache.set(key, result)
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with map_renders_lock:
+            del map_renders[key]
+
+class Job:
+    # A queued /jobs render. Progress runs to JOB_FETCH_SHARE while EarthMC batches arrive and to 100 once rendered
+    def __init__(self, options, estimated_towns):
+        self.id = uuid.uuid4().hex
+        self.options = options
+        self.key = map_request_key(options)
+        self.estimated_towns = estimated_towns
+        self.lock = threading.Lock()
+        self.status = 'queued'
+        self.progress = 0
+        self.planned = 0
+        self.fetched = 0
+        # Town and player batches are only planned once nations resolve, so the size estimate stands in until then
+        self.expected = -(-len(options['nation_names']) // MAX_QUERY_SIZE) + 2 * -(-estimated_towns // MAX_QUERY_SIZE)
+        self.result = None
+        self.error = None
+        self.error_status = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def update(self, planned=0, done=0):
+        with self.lock:
+            self.planned += planned
+            self.fetched += done
+            total = max(self.planned, self.expected)
+            if total:
+                self.progress = max(self.progress, JOB_FETCH_SHARE * min(self.fetched, total) // total)
+
+    def start(self, status):
+        with self.lock:
+            if self.status == 'cancelled':
+                return False
+            if self.started is None:
+                self.started = time.time()
+            self.status = status
+            if status == 'rendering':
+                self.progress = JOB_FETCH_SHARE
+            return True
+
+    def finish(self, status, result=None, error=None, error_status=None):
+        with self.lock:
+            if self.status == 'cancelled':
+                return
+            self.status = status
+            self.result = result
+            self.error = error
+            self.error_status = error_status
+            self.finished = time.time()
+            if status == 'done':
+                self.progress = 100
+        metrics.count('jobs_finished', status=status)
+
+    def cancel(self):
+        # Queued jobs are skipped; a running job's fetch and render finish for the map cache but its result is dropped
+        with self.lock:
+            if self.finished is not None:
+                return False
+            self.status = 'cancelled'
+            self.finished = time.time()
+        metrics.count('jobs_finished', status='cancelled')
+        return True
+
+    def info(self):
+        with self.lock:
+            info = {'id': self.id, 'status': self.status, 'progress': self.progress, 'estimated_towns': self.estimated_towns,
+                    'created': self.created, 'started': self.started, 'finished': self.finished}
+            if self.error is not None:
+                info['error'] = self.error
+            if self.finished is not None:
+                info['expires'] = self.finished + JOB_RESULT_TTL
+        info['status_url'] = f'/jobs/{self.id}'
+        if info['status'] == 'done':
+            info['result_url'] = f'/jobs/{self.id}/result'
+        return info
+
+jobs = {}
+job_queue = []  # Heap of (priority, sequence, job): smaller maps first, first come first served within a size class
+job_sequence = 0
+jobs_lock = threading.Condition()
+job_workers = []
+
+def estimate_towns(nation_names, town_names):
+    world = world_state
+    if world is not None:
+        return len(world.table.select(nation_names, town_names))
+    return len(town_names) + JOB_TOWNS_PER_NATION * len(nation_names)
+
+def expire_jobs():
+    now = time.time()
+    with jobs_lock:
+        for job_id in [job_id for job_id, job in jobs.items() if job.finished is not None and now - job.finished > JOB_RESULT_TTL]:
+            del jobs[job_id]
+
+def submit_job(options):
+    global job_sequence
+    start_job_workers()
+    expire_jobs()
+    job = Job(options, estimate_towns(options['nation_names'], options['town_names']))
+    with jobs_lock:
+        if sum(1 for queued in job_queue if queued[2].status == 'queued') >= JOB_QUEUE_SIZE:
+            raise MapRequestError("The job queue is full, please try again shortly.", 503, retry_after=RENDER_RETRY_AFTER)
+        job_sequence += 1
+        heapq.heappush(job_queue, (job.estimated_towns.bit_length(), job_sequence, job))
+        jobs[job.id] = job
+        jobs_lock.notify()
+    metrics.count('jobs_submitted')
+    return job
+
+def get_job(job_id):
+    expire_jobs()
+    with jobs_lock:
+        return jobs.get(job_id)
+
+def run_job(job):
+    cached = map_cache.get(job.key)
+    if cached is not None:
+        job.finish('done', cached)
+        return
+
+    options = dict(job.options)
+    encoding = options.pop('encoding')
+    if not job.start('fetching'):
+        return
+    token = fetch_progress.set(job)
+    try:
+        town_data, baseline, values = load_render_towns(options['nation_names'], options['town_names'], options['color_mode'],
+                                                        options['snapshot'], options['since'], options['until'])
+    finally:
+        fetch_progress.reset(token)
+
+    if not job.start('rendering'):
+        return
+    image = render_towns(town_data, baseline, values, options['show_home_blocks'], options['color_mode'], options['star_size'],
+                         options['renderer'], options['crop_clusters'], encoding, wait=True)
+    result = (image, hashlib.sha1(image).hexdigest())
+    map_cache.set(job.key, result)
+    job.finish('done', result)
+
+def job_worker():
+    while True:
+        with jobs_lock:
+            while not job_queue:
+                jobs_lock.wait()
+            _, _, job = heapq.heappop(job_queue)
+        if job.status == 'cancelled':
+            continue
+        try:
+            run_job(job)
+        except MapRequestError as e:
+            job.finish('failed', error=str(e), error_status=e.status)
+        except Exception as e:
+            app.logger.exception("Job %s failed", job.id)
+            job.finish('failed', error=f"Render failed: {e}", error_status=500)
+
+def start_job_workers():
+    with jobs_lock:
+        while len(job_workers) < JOB_WORKERS:
+            worker = threading.Thread(target=job_worker, name=f'job-worker-{len(job_workers)}', daemon=True)
+            worker.start()
+            job_workers.append(worker)
+
+class SamplingProfiler:
+    # Samples the stacks of the given threads until stopped; counts are kept per collapsed stack
+    def __init__(self, thread_ids, interval=PROFILE_INTERVAL):
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.samples = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='request-profiler', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in self.thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if stack:
+                    key = ';'.join(reversed(stack))
+                    self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.samples
+
+def save_profile(samples, route, seconds):
+    # Collapsed stacks, one 'frame;frame;frame count' line each, as read by flamegraph.pl and speedscope
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}-{route}.folded")
+    with open(path, 'w') as f:
+        f.writelines(f"{stack} {count}\n" for stack, count in sorted(samples.items()))
+    app.logger.warning("Slow request to %s took %.2fs, profile saved to %s", route, seconds, path)
+
+@app.before_request
+def start_world_refresh_once():
+    if world_refresh_thread is None:
+        start_world_refresh()
+
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    g.timings = []
+    g.timings_token = request_timings.set(g.timings)
+    g.profiler = None
+    if PROFILE_SLOW_REQUESTS is not None:
+        # The fetch loop thread is shared, so its samples can include other requests' fetches
+        fetch_threads = [thread.ident for thread in threading.enumerate() if thread.name == 'earthmc-fetch']
+        g.profiler = SamplingProfiler([threading.get_ident(), *fetch_threads])
+
+@app.after_request
+def finish_request_timing(response):
+    seconds = time.perf_counter() - g.request_start
+    if request.headers.get('X-Timing'):
+        response.headers['X-Timing'] = format_timings(g.timings + [('total', {}, seconds)])
+    metrics.observe('request', seconds, route=request.endpoint or 'unknown')
+    metrics.count('responses', route=request.endpoint or 'unknown', status=response.status_code)
+    return response
+
+@app.teardown_request
+def stop_request_profiler(exc):
+    if 'timings_token' not in g:
+        return
+    request_timings.reset(g.timings_token)
+    if g.profiler is not None:
+        samples = g.profiler.stop()
+        seconds = time.perf_counter() - g.request_start
+        if seconds >= PROFILE_SLOW_REQUESTS:
+            save_profile(samples, request.endpoint or 'unknown', seconds)
+
+def map_error_response(e):
+    headers = {'Retry-After': str(e.retry_after)} if e.retry_after else {}
+    return jsonify({"error": str(e)}), e.status, headers
+
+def map_image_response(image, etag, image_format, max_age):
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': f'public, max-age={max_age}'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+
+    # send_file streams the cached bytes in chunks instead of copying them into the response body
+    response = send_file(io.BytesIO(image), mimetype=OUTPUT_FORMATS[image_format])
+    response.headers.update(headers)
+    return response
 
 @app.route('/generate_map', methods=['POST'])
 def generate_map_api():
+    try:
+        options = parse_map_request(request.json)
+        image, etag = get_or_render(map_request_key(options), lambda: render_map_png(**options))
+    except MapRequestError as e:
+        return map_error_response(e)
+    return map_image_response(image, etag, options['encoding']['image_format'], MAP_CACHE_TTL)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job_api():
+    try:
+        job = submit_job(parse_map_request(request.json))
+    except MapRequestError as e:
+        return map_error_response(e)
+    return jsonify(job.info()), 202, {'Location': f'/jobs/{job.id}'}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status_api(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job."}), 404
+    return jsonify(job.info())
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result_api(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job."}), 404
+    info = job.info()
+    if info['status'] == 'failed':
+        return jsonify(info), job.error_status
+    if info['status'] == 'cancelled':
+        return jsonify(info), 410
+    if info['status'] != 'done':
+        return jsonify(info), 202, {'Retry-After': '1'}
+
+    image, etag = job.result
+    return map_image_response(image, etag, job.options['encoding']['image_format'], max(0, int(info['expires'] - time.time())))
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job_api(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job."}), 404
+    if not job.cancel():
+        return jsonify(dict(job.info(), error="The job has already finished.")), 409
+    return jsonify(job.info())
+
+@app.route('/tiles/info', methods=['GET'])
+def tile_info_api():
+    pyramid = get_tile_pyramid()
+    if pyramid is None:
+        return jsonify({"error": "World data is not loaded yet."}), 503, {'Retry-After': str(RENDER_RETRY_AFTER)}
+    return jsonify(pyramid.info())
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.png', methods=['GET'])
+def tile_api(z, x, y):
+    color_mode = request.args.get('color_mode', 'random')
+    pyramid = get_tile_pyramid()
+    if pyramid is None:
+        return jsonify({"error": "World data is not loaded yet."}), 503, {'Retry-After': str(RENDER_RETRY_AFTER)}
+
+    key = json.dumps([pyramid.world.updated, color_mode, z, x, y])
+    png = tile_cache.get(key)
+    if png is None:
+        try:
+            png = pyramid.render_tile(z, x, y, color_mode)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if png is None:
+            return jsonify({"error": "Tile out of range."}), 404
+        tile_cache.set(key, png)
+
+    response = send_file(io.BytesIO(png), mimetype='image/png')
+    response.headers['Cache-Control'] = f'public, max-age={TILE_CACHE_TTL}'
+    return response
+
+@app.route('/towns/at', methods=['GET'])
+def town_at_api():
+    x, z = request.args.get('x', type=int), request.args.get('z', type=int)
+    if x is None or z is None:
+        return jsonify({"error": "Please provide integer x and z town block coordinates."}), 400
+
+    index = get_block_index()
+    if index is None:
+        return jsonify({"error": "World data is not loaded yet."}), 503, {'Retry-After': str(RENDER_RETRY_AFTER)}
+
+    town = index.town_at(x, z)
+    return jsonify({"x": x, "z": z, "town": index.table.summary(town) if town >= 0 else None})
+
+@app.route('/towns/within', methods=['GET'])
+def towns_within_api():
+    rect = [request.args.get(key, type=int) for key in ('min_x', 'min_z', 'max_x', 'max_z')]
+    if None in rect:
+        return jsonify({"error": "Please provide integer min_x, min_z, max_x and max_z town block coordinates."}), 400
+
+    index = get_block_index()
+    if index is None:
+        return jsonify({"error": "World data is not loaded yet."}), 503, {'Retry-After': str(RENDER_RETRY_AFTER)}
+
+    return jsonify({"towns": [index.table.summary(town) for town in index.towns_in_rect(*rect)]})
+
+@app.route('/analytics', methods=['POST'])
+def analytics_api():
     data = request.json
-    nation_names = data.get('nation_names', '')
-    town_names = data.get('town_names', '')
-    show_home_blocks = data.get('show_home_blocks', True)
-    color_mode = data.get('color_mode', 'random')
-    star_size = data.get('star_size', 250)
-
+    nation_names = split_names(data.get('nation_names', ''))
+    town_names = split_names(data.get('town_names', ''))
     if not nation_names and not town_names:
         return jsonify({"error": "Please provide either nation names or individual town names."}), 400
 
-    nation_towns = get_nation_towns(nation_names) if nation_names else []
-    town_names_list = [name.strip() for name in town_names.split(',')] if town_names else []
-    all_town_names = nation_towns + town_names_list
-
-    if not all_town_names:
-        return jsonify({"error": "No valid town names found."}), 400
-
-    town_data = get_town_data(all_town_names)
+    try:
+        return jsonify(town_analytics(nation_names, town_names, data.get('snapshot')))
+    except MapRequestError as e:
+        return map_error_response(e)
+
+@app.route('/history', methods=['GET'])
+def history_api():
+    history = get_history_store()
+    if history is None:
+        return jsonify({"error": "History is not enabled on this server."}), 404
+    return jsonify({"entries": [dict(entry, removed=len(entry.get('removed', []))) for entry in history.entries]})
+
+@app.route('/snapshots', methods=['GET'])
+def list_snapshots_api():
+    snapshots = {}
+    if os.path.isdir(SNAPSHOT_DIR):
+        for name in sorted(os.listdir(SNAPSHOT_DIR)):
+            try:
+                snapshots[name] = read_snapshot_meta(snapshot_path(name))
+            except (MapRequestError, OSError, ValueError):
+                continue
+    return jsonify(snapshots)
+
+@app.route('/snapshots', methods=['POST'])
+def save_snapshot_api():
+    data = request.json
+    name = data.get('name', 'latest')
+    nation_names = split_names(data.get('nation_names', ''))
+    town_names = split_names(data.get('town_names', ''))
 
-    if not town_data:
-        return jsonify({"error": "No valid town data found."}), 400
+    if not nation_names and not town_names:
+        return jsonify({"error": "Please provide either nation names or individual town names."}), 400
 
     try:
-        fig = gentownsmap(town_data, show_home_blocks=show_home_blocks, 
-                          color_mode=color_mode, star_size=star_size)
-    except ValueError as e:
-        return jsonify({"error": str(e)}), 400
-
-    img_buffer = io.BytesIO()
-    fig.savefig(img_buffer, format='png', facecolor='#1e1e1e', edgecolor='none')
-    img_buffer.seek(0)
-    
-    return send_file(img_buffer, mimetype='image/png')
+        path = snapshot_path(name)
+        town_data = load_map_towns(nation_names, town_names, map_source())
+    except MapRequestError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    save_snapshot(town_data, path)
+    return jsonify(read_snapshot_meta(path)), 201
+
+@app.route('/metrics', methods=['GET'])
+def metrics_api():
+    gauges = {}
+    for name, cache in (('nations', nation_cache), ('towns', town_cache), ('players', player_cache), ('maps', map_cache), ('tiles', tile_cache)):
+        stats = cache.stats()
+        gauges[('cache_entries', (('cache', name),))] = stats['size']
+        gauges[('cache_hit_rate', (('cache', name),))] = stats['hit_rate']
+    world = world_state
+    if world is not None:
+        gauges[('world_towns', ())] = len(world.table)
+        gauges[('world_age_seconds', ())] = time.time() - world.updated
+    with jobs_lock:
+        gauges[('jobs_queued', ())] = sum(1 for queued in job_queue if queued[2].status == 'queued')
+    return Response(metrics.prometheus(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats', methods=['GET'])
+def stats_api():
+    world = world_state
+    with jobs_lock:
+        job_counts = {}
+        for job in jobs.values():
+            job_counts[job.status] = job_counts.get(job.status, 0) + 1
+    return jsonify({"jobs": job_counts, "cache": cache_stats(), "name_resolution": name_resolution_stats(), "maps": map_cache.stats(), "tiles": tile_cache.stats(), "earthmc_api": api_client.latency_stats(),
+                    "world": world.stats() if world is not None else None})
 
 if __name__ == "__main__":
     app.run(debug=True)
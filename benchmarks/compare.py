@@ -0,0 +1,40 @@
+import argparse
+import json
+import sys
+
+STAGES = ('fetch', 'rasterize', 'colorize', 'draw', 'encode', 'analytics', 'image_bytes', 'api', 'peak_memory_bytes')
+THRESHOLD = 1.25  # New/old ratio above which a stage counts as a regression
+MIN_SECONDS = 0.01  # Timings this short are mostly noise, so they never count as regressions
+
+def load_results(path):
+    with open(path) as f:
+        return {result['towns']: result for result in json.load(f)['results']}
+
+def compare(old_path, new_path, threshold=THRESHOLD):
+    old, new = load_results(old_path), load_results(new_path)
+    regressions = []
+    print(f"{'towns':>6} {'stage':<18} {'old':>10} {'new':>10} {'ratio':>7}")
+    for towns in sorted(old.keys() & new.keys()):
+        for stage in STAGES:
+            if stage not in old[towns] or stage not in new[towns]:
+                continue
+            before, after = old[towns][stage], new[towns][stage]
+            ratio = after / before if before else float('inf') if after else 1.0
+            noise = not stage.endswith('_bytes') and max(before, after) < MIN_SECONDS
+            flag = '  REGRESSION' if ratio > threshold and not noise else ''
+            print(f"{towns:>6} {stage:<18} {before:>10.4g} {after:>10.4g} {ratio:>6.2f}x{flag}")
+            if flag:
+                regressions.append((towns, stage, ratio))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help="new/old ratio that fails the comparison")
+    args = parser.parse_args()
+
+    regressions = compare(args.old, args.new, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} stage(s) regressed by more than {args.threshold:.2f}x")
+        sys.exit(1)
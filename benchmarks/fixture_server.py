@@ -0,0 +1,90 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fixtures import load_fixture, synthetic_fixture
+
+class FixtureServer:
+    # Stand-in for the EarthMC API: the same POST query endpoints and GET /towns list, served from a fixture
+    def __init__(self, fixture, latency=0.0, rate_429=0.0, host='127.0.0.1', port=0):
+        self.nations = {nation['name'].lower(): nation for nation in fixture['nations']}
+        self.towns = {town['name'].lower(): town for town in fixture['towns']}
+        self.players = {player['name'].lower(): player for player in fixture['players']}
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.requests = {'nations': 0, 'towns': 0, 'players': 0, '429': 0}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v3/aurora"
+
+    def handler(self):
+        fixture_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, data, status=200, headers=None):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if not self.path.endswith('/towns'):
+                    return self.send_json({'error': 'Not found'}, 404)
+                time.sleep(fixture_server.latency)
+                self.send_json([{'name': town['name'], 'uuid': town['uuid']} for town in fixture_server.towns.values()])
+
+            def do_POST(self):
+                query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['query']
+                endpoint = self.path.rstrip('/').rsplit('/', 1)[-1]
+                items = {'nations': fixture_server.nations, 'towns': fixture_server.towns, 'players': fixture_server.players}.get(endpoint)
+                if items is None:
+                    return self.send_json({'error': 'Not found'}, 404)
+
+                time.sleep(fixture_server.latency)
+                with fixture_server.lock:
+                    limited = random.random() < fixture_server.rate_429
+                    fixture_server.requests['429' if limited else endpoint] += 1
+                if limited:
+                    return self.send_json({'error': 'Too many requests'}, 429, {'Retry-After': '0'})
+                self.send_json([items[name.lower()] for name in query if name.lower() in items])
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='fixture-server', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve an EarthMC API fixture locally")
+    parser.add_argument('--fixture', help="fixture file from fixtures.py")
+    parser.add_argument('--synthetic', type=int, default=1000, metavar='TOWNS', help="synthetic towns when no fixture is given")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="fraction of queries answered with HTTP 429")
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    fixture = load_fixture(args.fixture) if args.fixture else synthetic_fixture(args.synthetic)
+    server = FixtureServer(fixture, args.latency, args.rate_429, port=args.port)
+    print(f"Serving {len(server.towns)} towns at {server.url}")
+    server.server.serve_forever()
@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+import gzip
+import importlib.util
+import json
+import os
+import random
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_MODULE = 'plutonium_api'
+sys.path.insert(0, REPO_DIR)
+
+WORLD_X = (-2080, 2080)  # Aurora's extent in town block coordinates
+WORLD_Z = (-1035, 1035)
+TOWNS_PER_NATION = 12
+MAX_TOWN_BLOCKS = 2000
+
+def synthetic_fixture(town_count, seed=0):
+    # Towns grow as random blobs around random centers, with a lognormal claim size like the live server
+    rng = random.Random(seed)
+    now = int(time.time() * 1000)
+    claimed = set()
+    towns = []
+    players = []
+
+    for i in range(town_count):
+        center = (rng.randint(*WORLD_X), rng.randint(*WORLD_Z))
+        size = min(int(rng.lognormvariate(3, 1)) + 1, MAX_TOWN_BLOCKS)
+        blocks = []
+        frontier = [center]
+        while frontier and len(blocks) < size:
+            block = frontier.pop(rng.randrange(len(frontier)))
+            if block in claimed:
+                continue
+            claimed.add(block)
+            blocks.append(list(block))
+            x, z = block
+            frontier.extend([(x + 1, z), (x - 1, z), (x, z + 1), (x, z - 1)])
+        if not blocks:
+            continue
+
+        nation = i // TOWNS_PER_NATION
+        mayor = f'Mayor{i}'
+        towns.append({
+            'name': f'Town{i}',
+            'uuid': f'town-{i}',
+            'nation': {'name': f'Nation{nation}', 'uuid': f'nation-{nation}'} if rng.random() < 0.8 else {'name': None, 'uuid': None},
+            'mayor': {'name': mayor, 'uuid': f'player-{i}'},
+            'coordinates': {'townBlocks': blocks, 'homeBlock': blocks[0], 'spawn': {}},
+            'stats': {'numTownBlocks': len(blocks), 'numResidents': rng.randint(1, 40), 'numOutlaws': rng.randint(0, 5),
+                      'numTrusted': rng.randint(0, 8), 'maxTownBlocks': len(blocks) + 50, 'balance': 0.0, 'forSale': None},
+            'status': {'isOpen': rng.random() < 0.5, 'isOverClaimed': rng.random() < 0.1,
+                       'hasOverclaimShield': rng.random() < 0.3, 'isPublic': rng.random() < 0.5},
+        })
+        players.append({'name': mayor, 'uuid': f'player-{i}', 'timestamps': {'lastOnline': now - rng.randint(0, 90) * 86400000}})
+
+    return build_fixture(towns, players)
+
+def build_fixture(towns, players):
+    nations = {}
+    for town in towns:
+        name = (town.get('nation') or {}).get('name')
+        if name:
+            nations.setdefault(name, []).append({'name': town['name'], 'uuid': town['uuid']})
+    return {'nations': [{'name': name, 'towns': nation_towns} for name, nation_towns in nations.items()],
+            'towns': towns, 'players': players}
+
+def load_api():
+    # The API script's file name is not importable, so it is loaded by path under a fixed module name;
+    # spawned render workers unpickle their functions from sys.modules under that same name
+    if API_MODULE not in sys.modules:
+        spec = importlib.util.spec_from_file_location(API_MODULE, os.path.join(REPO_DIR, 'PlutoniumAPI[Bata].py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[API_MODULE] = module
+        spec.loader.exec_module(module)
+    return sys.modules[API_MODULE]
+
+def record_fixture(nation_names=None):
+    # Raw responses from the live API, so replays exercise the same parsing as production
+    from plutonium import fetch
+
+    if nation_names:
+        town_names = fetch.get_nation_towns(','.join(nation_names))
+    else:
+        town_names = fetch.run_sync(fetch.fetch_all_town_names())
+
+    async def fetch_raw(url, names):
+        batches = await asyncio.gather(*(fetch.api_client.post(url, batch) for batch in fetch.batch_requests(names)))
+        return [item for batch in batches for item in batch]
+
+    towns = fetch.run_sync(fetch_raw(fetch.API_TOWNS, town_names))
+    mayors = fetch.unique_names(town['mayor']['name'] for town in towns)
+    players = fetch.run_sync(fetch_raw(fetch.API_PLAYERS, mayors))
+    return build_fixture(towns, players)
+
+def load_fixture(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        return json.load(f)
+
+def save_fixture(fixture, path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt') as f:
+        json.dump(fixture, f)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create EarthMC API fixtures for the benchmarks")
+    parser.add_argument('output', help="fixture file to write, gzipped when it ends in .gz")
+    parser.add_argument('--synthetic', type=int, metavar='TOWNS', help="generate this many synthetic towns instead of recording")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--nations', help="comma-separated nations to record (default: the whole world)")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        fixture = synthetic_fixture(args.synthetic, args.seed)
+    else:
+        fixture = record_fixture(args.nations.split(',') if args.nations else None)
+    save_fixture(fixture, args.output)
+    print(f"Wrote {len(fixture['towns'])} towns and {len(fixture['players'])} players to {args.output}")
@@ -0,0 +1,75 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from fixtures import REPO_DIR
+
+REPEATS = 5
+# Median seconds to import each target in a fresh interpreter, enforced by --check
+BUDGETS = {
+    'plutonium.data': 0.25,
+    'plutonium.fetch': 0.3,
+    'plutonium.render': 0.3,
+    'api': 0.6,
+    'cli': 0.4,
+}
+# Modules each target has to leave for first use, also enforced by --check
+LAZY = {
+    'plutonium.fetch': ('aiohttp',),
+    'plutonium.render': ('matplotlib',),
+    'api': ('matplotlib', 'aiohttp'),
+    'cli': ('matplotlib', 'tkinter'),
+}
+# Targets that are scripts at the repository root rather than modules
+SCRIPTS = {'api': 'PlutoniumAPI[Bata].py', 'cli': 'Plutonium.py'}
+HEAVY_MODULES = ('matplotlib', 'matplotlib.pyplot', 'tkinter', 'aiohttp', 'flask')
+
+# Run in the child: imports one target and reports its wall time and which heavy modules it pulled in
+PROBE = '''
+import importlib.util, json, sys, time
+sys.path.insert(0, {repo!r})
+start = time.perf_counter()
+if {script_path!r}:
+    spec = importlib.util.spec_from_file_location('plutonium_' + {target!r}, {script_path!r})
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+else:
+    importlib.import_module({target!r})
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+'''
+
+def measure(target, repeats=REPEATS):
+    script_path = os.path.join(REPO_DIR, SCRIPTS[target]) if target in SCRIPTS else None
+    code = PROBE.format(repo=REPO_DIR, target=target, script_path=script_path, heavy=HEAVY_MODULES)
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return statistics.median(run['seconds'] for run in runs), runs[-1]['loaded']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure how long the shared modules and the API take to import")
+    parser.add_argument('targets', nargs='*', default=list(BUDGETS), help="modules to import, or 'api' or 'cli' for the scripts")
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--check', action='store_true', help="exit with status 1 when a target is over its budget or imports eagerly")
+    args = parser.parse_args()
+
+    failed = []
+    for target in args.targets:
+        seconds, loaded = measure(target, args.repeats)
+        budget = BUDGETS.get(target)
+        status = '' if budget is None else ('  OVER BUDGET' if seconds > budget else f'  budget {budget:.2f}s')
+        eager = [name for name in LAZY.get(target, ()) if name in loaded]
+        if eager:
+            status += f"  EAGER {', '.join(eager)}"
+        if (budget is not None and seconds > budget) or eager:
+            failed.append(target)
+        print(f"{target:<18} {seconds:.3f}s  loads {', '.join(loaded) or 'none of ' + ', '.join(HEAVY_MODULES)}{status}")
+
+    if args.check and failed:
+        sys.exit(1)
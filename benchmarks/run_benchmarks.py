@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+
+from fixtures import load_api, load_fixture, synthetic_fixture
+from fixture_server import FixtureServer
+from plutonium import analytics, data, fetch, render
+
+SIZES = (10, 100, 1000, 10000, 50000)
+REPEATS = 3
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+FETCH_RATE_LIMIT = 1000  # Requests per second, high enough that the fixture server is the only limit
+
+def timed(func, repeats=REPEATS):
+    # Median wall time of repeats calls, and the last result
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds), result
+
+def clear_caches():
+    for cache in (fetch.nation_cache, fetch.town_cache, fetch.player_cache):
+        cache.clear()
+
+def use_fixture_server(server, rate_limit):
+    fetch.API_NATIONS = f"{server.url}/nations"
+    fetch.API_TOWNS = f"{server.url}/towns"
+    fetch.API_PLAYERS = f"{server.url}/players"
+    fetch.run_sync(fetch.api_client.close())
+    fetch.api_client = fetch.EarthMCClient(rate=rate_limit, burst=rate_limit)
+
+def bench_fetch(town_names):
+    def fetch_towns():
+        clear_caches()
+        return fetch.get_town_data(town_names)
+    return timed(fetch_towns, 1)
+
+def bench_render(table, color_mode, renderer, grid_mode, image_format):
+    # Each stage on its own, so a regression points at the stage that caused it
+    result = {}
+    result['rasterize'], (clusters, bounds) = timed(lambda: render.rasterize_map(table, grid_mode))
+    result['colorize'], _ = timed(lambda: render.build_palette(render.town_colors(table, color_mode)))
+    result['draw'], image = timed(lambda: render.draw_town_map(table, clusters, bounds, color_mode=color_mode, renderer=renderer))
+    result['encode'], encoded = timed(lambda: render.encode_image(image, image_format))
+    result['analytics'], _ = timed(lambda: analytics.TownAnalytics(table, clusters))
+    result['image_bytes'] = len(encoded)
+    return result
+
+def bench_peak_memory(table, color_mode, renderer, grid_mode, image_format):
+    # A separate pass, since tracemalloc slows down everything it traces
+    tracemalloc.start()
+    try:
+        render.encode_image(render.gentownsmap(table, color_mode=color_mode, renderer=renderer, grid_mode=grid_mode), image_format)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def warm_up_render_pool():
+    # Workers import matplotlib on their first render, which would otherwise land in the first size's timing
+    api = load_api()
+    table = data.TownTable.from_json([data.compact_town(town) for town in synthetic_fixture(10)['towns']])
+    futures = [api.get_render_pool().submit(render.render_png, table, True, 'random', 250, 'imshow') for _ in range(api.RENDER_WORKERS)]
+    for future in futures:
+        future.result()
+
+def bench_api(town_names, color_mode, renderer, image_format):
+    # The whole /generate_map path through Flask, fetching from the fixture server and rendering in the pool
+    api = load_api()
+    clear_caches()
+    api.map_cache.clear()
+    client = api.app.test_client()
+    start = time.perf_counter()
+    response = client.post('/generate_map', headers={'X-Timing': '1'},
+                           json={'town_names': ','.join(town_names), 'color_mode': color_mode, 'renderer': renderer,
+                                 'format': image_format})
+    seconds = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f"/generate_map returned HTTP {response.status_code}: {response.get_data(as_text=True)}")
+    spans = dict(span.split('=') for span in response.headers['X-Timing'].split(', '))
+    return seconds, {name: float(value) for name, value in spans.items()}
+
+def run(sizes, fixture_path, seed, color_mode, renderer, grid_mode, image_format, latency, rate_429, rate_limit, with_api):
+    base_fixture = load_fixture(fixture_path) if fixture_path else None
+    if with_api:
+        warm_up_render_pool()
+    results = []
+    for size in sizes:
+        if base_fixture is not None:
+            fixture = dict(base_fixture, towns=base_fixture['towns'][:size])
+        else:
+            fixture = synthetic_fixture(size, seed)
+        town_names = [town['name'] for town in fixture['towns']]
+
+        server = FixtureServer(fixture, latency, rate_429).start()
+        try:
+            use_fixture_server(server, rate_limit)
+            result = {'towns': len(town_names)}
+            result['fetch'], table = bench_fetch(town_names)
+            result['fetch_requests'] = dict(server.requests)
+            result['blocks'] = len(table.blocks)
+            result.update(bench_render(table, color_mode, renderer, grid_mode, image_format))
+            result['peak_memory_bytes'] = bench_peak_memory(table, color_mode, renderer, grid_mode, image_format)
+            if with_api:
+                result['api'], result['api_spans'] = bench_api(town_names, color_mode, renderer, image_format)
+        finally:
+            fetch.run_sync(fetch.api_client.close())
+            server.stop()
+
+        results.append(result)
+        print(f"{result['towns']:>6} towns {result['blocks']:>8} blocks  fetch {result['fetch']:.3f}s  "
+              f"rasterize {result['rasterize']:.3f}s  colorize {result['colorize']:.3f}s  draw {result['draw']:.3f}s  "
+              f"encode {result['encode']:.3f}s  analytics {result['analytics']:.3f}s  peak {result['peak_memory_bytes'] / 2 ** 20:.1f}MB"
+              + (f"  api {result['api']:.3f}s" if with_api else ''))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark fetching, rasterizing, coloring, drawing and encoding maps")
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)), help="comma-separated town counts")
+    parser.add_argument('--fixture', help="recorded fixture to take towns from instead of synthetic ones")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--color-mode', default='random', choices=render.COLOR_MODES)
+    parser.add_argument('--renderer', default='imshow', choices=render.RENDERERS)
+    parser.add_argument('--grid-mode', default='auto', choices=render.GRID_MODES)
+    parser.add_argument('--format', default='png', choices=render.OUTPUT_FORMATS)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the fixture server adds to every response")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="fraction of fixture server responses that are HTTP 429")
+    parser.add_argument('--rate-limit', type=float, default=FETCH_RATE_LIMIT, help="client requests per second")
+    parser.add_argument('--no-api', action='store_true', help="skip the end-to-end /generate_map pass")
+    parser.add_argument('--output', help="results file (default: results/<timestamp>.json)")
+    args = parser.parse_args()
+
+    results = run([int(size) for size in args.sizes.split(',')], args.fixture, args.seed, args.color_mode, args.renderer,
+                  args.grid_mode, args.format, args.latency, args.rate_429, args.rate_limit, not args.no_api)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'created': time.time(), 'python': platform.python_version(), 'machine': platform.machine(),
+                   'options': vars(args), 'results': results}, f, indent=2)
+    print(f"Results saved to {output}")
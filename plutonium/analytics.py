@@ -0,0 +1,288 @@
+import numpy as np
+
+from .metrics import metrics
+from .render import rasterize_map
+
+# scipy labels components and finds nearest neighbours faster; without it numpy does both
+try:
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.spatial import cKDTree
+except ImportError:
+    coo_matrix = connected_components = cKDTree = None
+
+WILDERNESS = -1  # Realm of unclaimed blocks
+NEAREST_MAX_RADIUS = 8  # Cells the numpy nearest neighbour search looks out before comparing a point with every other
+NEAREST_CHUNK_CELLS = 1000000  # Distance matrix entries computed at once when it does
+
+# Shifted views pairing every grid cell with its right neighbour, then with the one below it
+NEIGHBOUR_SHIFTS = ((np.s_[:, :-1], np.s_[:, 1:]), (np.s_[:-1, :], np.s_[1:, :]))
+
+def label_components(first, second, count):
+    # Connected component of each of count nodes joined by the edges first[i] - second[i], numbered from 0
+    if connected_components is not None:
+        graph = coo_matrix((np.ones(len(first), dtype=np.int8), (first, second)), shape=(count, count))
+        return connected_components(graph, directed=False)[1]
+
+    # Every root hooks onto the smallest root it shares an edge with, then pointer jumping flattens the
+    # trees, until no edge joins two roots; a handful of rounds even for the largest nations
+    labels = np.arange(count)
+    while len(first):
+        first_root, second_root = labels[first], labels[second]
+        joined = first_root != second_root
+        first, second = first[joined], second[joined]
+        low = np.minimum(first_root[joined], second_root[joined])
+        high = np.maximum(first_root[joined], second_root[joined])
+        order = np.argsort(low, kind='stable')[::-1]  # Of several hooks onto one root, the smallest is written last
+        labels[high[order]] = low[order]
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+    return np.unique(labels, return_inverse=True)[1]
+
+def ragged_ranges(starts, counts):
+    # Concatenation of range(start, start + count) for every start and count
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - counts - starts, counts)
+
+def nearest_points(points):
+    # Index of and distance to every point's nearest other point; points with NaN get -1 and NaN
+    nearest = np.full(len(points), -1, dtype=np.int64)
+    distance = np.full(len(points), np.nan)
+    valid = np.flatnonzero(~np.isnan(points).any(axis=1))
+    if len(valid) < 2:
+        return nearest, distance
+    candidates = points[valid]
+
+    if cKDTree is not None:
+        distances, indices = cKDTree(candidates).query(candidates, k=2)
+        # Of two points in the same place either may come first, so the nearest is whichever is not the point itself
+        others = np.where(indices[:, 1] == np.arange(len(candidates)), indices[:, 0], indices[:, 1])
+        nearest[valid], distance[valid] = valid[others], distances[:, 1]
+        return nearest, distance
+
+    # Points are bucketed into square cells of about two points each and searched for in the cells within
+    # radius of their own. Every point outside those cells is more than radius cell widths away, so a nearest
+    # found within that distance is final; the rest widen the search, and stragglers are compared with all
+    origin = candidates.min(axis=0)
+    extent = np.maximum(candidates.max(axis=0) - origin, 1)
+    cell_size = max(np.sqrt(extent[0] * extent[1] * 2 / len(candidates)), 1.0)
+    cells = ((candidates - origin) // cell_size).astype(np.int64)
+    rows = int(cells[:, 1].max()) + 1
+    keys = cells[:, 0] * rows + cells[:, 1]  # Offsets past the top or bottom row land in other columns, which only adds candidates
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    best = np.full(len(candidates), np.inf)
+    best_index = np.full(len(candidates), -1, dtype=np.int64)
+    pending = np.arange(len(candidates))
+    searched, radius = -1, 1
+    while len(pending) and radius <= NEAREST_MAX_RADIUS:
+        for dx in range(-radius, radius + 1):
+            for dy in range(-radius, radius + 1):
+                if max(abs(dx), abs(dy)) <= searched:
+                    continue
+                neighbour_keys = keys[pending] + dx * rows + dy
+                starts = np.searchsorted(sorted_keys, neighbour_keys, 'left')
+                counts = np.searchsorted(sorted_keys, neighbour_keys, 'right') - starts
+                if not counts.any():
+                    continue
+                owners = np.repeat(pending, counts)
+                others = order[ragged_ranges(starts, counts)]
+                squared = ((candidates[owners] - candidates[others]) ** 2).sum(axis=1)
+                squared[owners == others] = np.inf
+                # Furthest first, so of several improvements to one point the closest is written last
+                closest_last = np.argsort(-squared, kind='stable')
+                owners, others, squared = owners[closest_last], others[closest_last], squared[closest_last]
+                better = squared < best[owners]
+                best[owners[better]] = squared[better]
+                best_index[owners[better]] = others[better]
+        pending = pending[best[pending] > (radius * cell_size) ** 2]
+        searched, radius = radius, radius * 2
+
+    step = max(1, NEAREST_CHUNK_CELLS // len(candidates))
+    for start in range(0, len(pending), step):
+        chunk = pending[start:start + step]
+        rows = np.arange(len(chunk))
+        squared = (candidates[chunk, :1] - candidates[:, 0]) ** 2 + (candidates[chunk, 1:] - candidates[:, 1]) ** 2
+        squared[rows, chunk] = np.inf
+        closest = squared.argmin(axis=1)
+        best[chunk], best_index[chunk] = squared[rows, closest], closest
+
+    nearest[valid], distance[valid] = valid[best_index], np.sqrt(best)
+    return nearest, distance
+
+class TownAnalytics:
+    # Borders, frontiers, enclaves, compactness and nearest neighbours of every town, from the town-index
+    # grid compared against itself shifted by one block. Towns missing from the table count as wilderness,
+    # so analyse the whole world for results that match it
+    def __init__(self, table, clusters=None):
+        self.table = table
+        count = len(table)
+        if clusters is None:
+            clusters, _ = rasterize_map(table)
+
+        # A realm is a town's nation, or the town on its own when it has none
+        self.nation_count = len(table.nation_names)
+        self.realms = np.where(table.nation_codes >= 0, table.nation_codes, self.nation_count + np.arange(count))
+        realm_lut = np.concatenate([[WILDERNESS], self.realms])
+
+        perimeter = np.zeros(count + 1, dtype=np.int64)
+        frontier = np.zeros(count + 1, dtype=np.int64)
+        node_towns, town_edges, realm_edges, boundaries, pair_keys = [], [], [], [], []
+        node_count = 0
+        for grid, _ in clusters:
+            # Padded with wilderness, so blocks on the grid's edge still have four neighbours
+            padded = np.pad(grid, 1)
+            claimed = padded > 0
+            nodes = np.full(padded.shape, -1, dtype=np.int64)
+            nodes[claimed] = np.arange(node_count, node_count + int(claimed.sum()))
+            node_count += int(claimed.sum())
+            node_towns.append(padded[claimed] - 1)
+            realm_grid = realm_lut[padded]
+            is_frontier = np.zeros(padded.shape, dtype=bool)
+
+            for first, second in NEIGHBOUR_SHIFTS:
+                town_a, town_b = padded[first], padded[second]
+                realm_a, realm_b = realm_grid[first], realm_grid[second]
+                node_a, node_b = nodes[first], nodes[second]
+                claimed_a, claimed_b = claimed[first], claimed[second]
+
+                differs = town_a != town_b
+                perimeter += np.bincount(town_a[differs], minlength=count + 1) + np.bincount(town_b[differs], minlength=count + 1)
+
+                same_town = ~differs & claimed_a
+                town_edges.append((node_a[same_town], node_b[same_town]))
+                same_realm = (realm_a == realm_b) & claimed_a
+                realm_edges.append((node_a[same_realm], node_b[same_realm]))
+
+                foreign = claimed_a & claimed_b & ~same_realm
+                is_frontier[first] |= foreign
+                is_frontier[second] |= foreign
+
+                between = claimed_a & claimed_b & differs
+                low, high = np.minimum(town_a[between], town_b[between]) - 1, np.maximum(town_a[between], town_b[between]) - 1
+                pair_keys.append(low.astype(np.int64) * count + high)
+
+                # Each realm boundary as seen from both of its sides, wilderness included
+                for side, node, other_realm in ((claimed_a, node_a, realm_b), (claimed_b, node_b, realm_a)):
+                    outward = side & ~same_realm
+                    boundaries.append((node[outward], other_realm[outward]))
+
+            frontier += np.bincount(padded[is_frontier], minlength=count + 1)
+
+        self.node_towns = np.concatenate(node_towns)
+        self.area = np.bincount(self.node_towns, minlength=count)
+        self.perimeter = perimeter[1:]
+        # 1 for a square, the shape with the shortest border for its area, and lower the more spread out a claim is
+        self.compactness = np.where(self.area > 0, 4 * np.sqrt(self.area) / np.maximum(self.perimeter, 1), 0.0)
+        self.frontier_blocks = frontier[1:]
+        self.frontier_share = self.frontier_blocks / np.maximum(self.area, 1)
+
+        town_parts = label_components(*(np.concatenate(edges) for edges in zip(*town_edges)), node_count)
+        part_towns = np.zeros(town_parts.max(initial=-1) + 1, dtype=np.int64)
+        part_towns[town_parts] = self.node_towns
+        self.parts = np.bincount(part_towns, minlength=count)
+        self.realm_parts = label_components(*(np.concatenate(edges) for edges in zip(*realm_edges)), node_count).astype(np.int64)
+
+        # A realm part is an enclave when every block bordering it belongs to one other realm
+        boundary_nodes, boundary_realms = (np.concatenate(values) for values in zip(*boundaries))
+        realm_limit = int(self.realms.max(initial=0)) + 2
+        keys = np.unique(self.realm_parts[boundary_nodes] * realm_limit + boundary_realms + 1)
+        parts, neighbours = keys // realm_limit, keys % realm_limit - 1
+        part_count = int(self.realm_parts.max(initial=-1)) + 1
+        single = np.bincount(parts, minlength=part_count) == 1
+        self.enclosing = np.full(part_count, WILDERNESS, dtype=np.int64)
+        self.enclosing[parts[single[parts]]] = neighbours[single[parts]]
+        enclave_nodes = self.enclosing[self.realm_parts] != WILDERNESS
+        self.enclave_of = np.full(count, WILDERNESS, dtype=np.int64)
+        self.enclave_of[self.node_towns[enclave_nodes]] = self.enclosing[self.realm_parts[enclave_nodes]]
+
+        pairs, lengths = np.unique(np.concatenate(pair_keys), return_counts=True)
+        first_towns, second_towns = pairs // max(count, 1), pairs % max(count, 1)
+        foreign = self.realms[first_towns] != self.realms[second_towns]
+        self.foreign_border = (np.bincount(first_towns[foreign], lengths[foreign], minlength=count)
+                               + np.bincount(second_towns[foreign], lengths[foreign], minlength=count)).astype(np.int64)
+        self.border_pairs = np.column_stack([first_towns, second_towns])
+        self.border_lengths = lengths
+
+        # Both directions of every border sorted by town, so one town's neighbours are a contiguous slice
+        sources = np.concatenate([first_towns, second_towns])
+        order = np.argsort(sources, kind='stable')
+        self.neighbours = np.concatenate([second_towns, first_towns])[order]
+        self.neighbour_lengths = np.concatenate([lengths, lengths])[order]
+        self.neighbour_offsets = np.searchsorted(sources[order], np.arange(count + 1))
+
+        # Nearest neighbours by the centre of each town's claim
+        blocks = table.blocks.astype(np.float64)
+        town_ids = table.town_ids
+        block_counts = np.bincount(town_ids, minlength=count)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            centroids = np.column_stack([np.bincount(town_ids, blocks[:, 0], minlength=count),
+                                         np.bincount(town_ids, blocks[:, 1], minlength=count)]) / block_counts[:, None]
+        self.nearest, self.nearest_distance = nearest_points(centroids)
+
+    def realm_name(self, realm):
+        if realm < self.nation_count:
+            return self.table.nation_names[realm]
+        return self.table.names[realm - self.nation_count]
+
+    def town_borders(self, index):
+        start, end = self.neighbour_offsets[index], self.neighbour_offsets[index + 1]
+        return {self.table.names[town]: int(length) for town, length in zip(self.neighbours[start:end], self.neighbour_lengths[start:end])}
+
+    def town_stats(self, index):
+        nation_code = self.table.nation_codes[index]
+        enclave_of, nearest = self.enclave_of[index], self.nearest[index]
+        return {
+            'name': self.table.names[index],
+            'nation': self.table.nation_names[nation_code] if nation_code >= 0 else None,
+            'blocks': int(self.area[index]),
+            'perimeter': int(self.perimeter[index]),
+            'compactness': round(float(self.compactness[index]), 4),
+            'parts': int(self.parts[index]),
+            'frontier_blocks': int(self.frontier_blocks[index]),
+            'foreign_border': int(self.foreign_border[index]),
+            'enclave_of': self.realm_name(enclave_of) if enclave_of != WILDERNESS else None,
+            'nearest_town': self.table.names[nearest] if nearest >= 0 else None,
+            'nearest_distance': None if nearest < 0 else round(float(self.nearest_distance[index]), 1),
+            'borders': self.town_borders(index),
+        }
+
+    def nation_borders(self, nation_codes=None):
+        # Border length between every two bordering nations, longest first, optionally only those involving nation_codes
+        realms = np.sort(self.realms[self.border_pairs], axis=1)
+        between_nations = (realms[:, 1] < self.nation_count) & (realms[:, 0] != realms[:, 1])
+        if nation_codes is not None:
+            between_nations &= np.isin(realms, list(nation_codes)).any(axis=1)
+        keys, inverse = np.unique(realms[between_nations, 0] * self.nation_count + realms[between_nations, 1], return_inverse=True)
+        lengths = np.bincount(inverse.reshape(-1), self.border_lengths[between_nations], minlength=len(keys)).astype(np.int64)
+        return [{'nations': [self.table.nation_names[key // self.nation_count], self.table.nation_names[key % self.nation_count]],
+                 'length': int(length)} for key, length in sorted(zip(keys, lengths), key=lambda item: -item[1])]
+
+    def enclaves(self, towns=None):
+        # Every realm part enclosed by a single other realm, optionally only those containing one of towns
+        enclave_nodes = np.flatnonzero(self.enclosing[self.realm_parts] != WILDERNESS)
+        enclave_nodes = enclave_nodes[np.argsort(self.realm_parts[enclave_nodes], kind='stable')]
+        parts, starts = np.unique(self.realm_parts[enclave_nodes], return_index=True)
+        results = []
+        for part, nodes in zip(parts, np.split(enclave_nodes, starts[1:])):
+            members = np.unique(self.node_towns[nodes])
+            if towns is not None and not np.isin(members, towns).any():
+                continue
+            results.append({'realm': self.realm_name(self.realms[members[0]]), 'surrounded_by': self.realm_name(self.enclosing[part]),
+                            'blocks': len(nodes), 'towns': [self.table.names[town] for town in members]})
+        return results
+
+last_analytics = None
+
+def analyze(table):
+    # Analytics of the last table asked about are kept, so switching between analytics color modes is instant
+    global last_analytics
+    analytics = last_analytics
+    if analytics is None or analytics.table is not table:
+        with metrics.span('analytics'):
+            analytics = last_analytics = TownAnalytics(table)
+    return analytics
@@ -0,0 +1,489 @@
+import bisect
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+
+import numpy as np
+
+STAT_KEYS = ('numTownBlocks', 'numResidents', 'numOutlaws', 'numTrusted')
+STATUS_KEYS = ('isOpen', 'isOverClaimed', 'hasOverclaimShield')
+
+SNAPSHOT_VERSION = 1
+
+HISTORY_KEYFRAME_EVERY = 24  # Full snapshot every this many history entries, deltas in between
+HISTORY_CACHE_TTL = 600  # Seconds
+HISTORY_CACHE_SIZE = 8
+
+INDEX_CHUNK_BITS = 4  # BlockIndex looks blocks up in 16x16 chunks
+INDEX_TABLE_MAX_CELLS = 16000000  # Chunk directory plus chunk cells; sparser worlds fall back to a sorted search
+
+CLAIM_CHANGES = 'Claim Changes'  # Needs a baseline table, so it is not one of COLOR_MODES
+CLAIM_CHANGE_COLORS = {'Unchanged': 'grey', 'Gained': '#2ecc71', 'Lost': '#e74c3c'}
+
+class TownTable:
+    def __init__(self, names, mayors, nation_codes, nation_names, stats, status, home_blocks, blocks, offsets, mayor_last_online=None):
+        self.names = names  # Interned town names (object array)
+        self.mayors = mayors
+        self.nation_codes = nation_codes  # Index into nation_names, -1 for towns without a nation
+        self.nation_names = nation_names
+        self.stats = stats
+        self.status = status
+        self.home_blocks = home_blocks  # float64 (x, y) pairs, NaN when a town has no homeblock
+        self.blocks = blocks  # int32 (x, y) pairs of every town, concatenated
+        self.offsets = offsets  # Town i owns blocks[offsets[i]:offsets[i + 1]]
+        self.mayor_last_online = np.full(len(names), np.nan) if mayor_last_online is None else mayor_last_online
+
+    @classmethod
+    def from_json(cls, towns):
+        nation_index = {}
+        nation_codes = np.empty(len(towns), dtype=np.int32)
+        for i, town in enumerate(towns):
+            nation = (town.get('nation') or {}).get('name')
+            nation_codes[i] = nation_index.setdefault(sys.intern(nation), len(nation_index)) if nation else -1
+
+        town_blocks = [block_array(town['coordinates']['townBlocks']) for town in towns]
+        block_counts = np.fromiter((len(blocks) for blocks in town_blocks), dtype=np.int64, count=len(towns))
+
+        return cls(
+            names=np.array([sys.intern(town['name']) for town in towns], dtype=object),
+            mayors=np.array([sys.intern(town['mayor']['name']) for town in towns], dtype=object),
+            nation_codes=nation_codes,
+            nation_names=list(nation_index),
+            stats={key: np.array([town['stats'][key] for town in towns], dtype=np.int32) for key in STAT_KEYS},
+            status={key: np.array([bool(town['status'][key]) for town in towns], dtype=bool) for key in STATUS_KEYS},
+            home_blocks=np.array([town['coordinates']['homeBlock'] or (np.nan, np.nan) for town in towns], dtype=np.float64).reshape(-1, 2),
+            blocks=np.concatenate(town_blocks) if towns else np.empty((0, 2), dtype=np.int32),
+            offsets=np.concatenate([[0], np.cumsum(block_counts)]),
+            mayor_last_online=np.array([town.get('mayor_last_online', np.nan) for town in towns], dtype=np.float64),
+        )
+
+    @classmethod
+    def concat(cls, tables):
+        nation_index = {}
+        nation_codes = []
+        for table in tables:
+            # The trailing -1 keeps towns without a nation at -1
+            remap = np.array([nation_index.setdefault(name, len(nation_index)) for name in table.nation_names] + [-1], dtype=np.int32)
+            nation_codes.append(remap[table.nation_codes])
+
+        block_counts = np.concatenate([np.diff(table.offsets) for table in tables])
+
+        return cls(
+            names=np.concatenate([table.names for table in tables]),
+            mayors=np.concatenate([table.mayors for table in tables]),
+            nation_codes=np.concatenate(nation_codes),
+            nation_names=list(nation_index),
+            stats={key: np.concatenate([table.stats[key] for table in tables]) for key in STAT_KEYS},
+            status={key: np.concatenate([table.status[key] for table in tables]) for key in STATUS_KEYS},
+            home_blocks=np.concatenate([table.home_blocks for table in tables]),
+            blocks=np.concatenate([table.blocks for table in tables]),
+            offsets=np.concatenate([[0], np.cumsum(block_counts)]),
+            mayor_last_online=np.concatenate([table.mayor_last_online for table in tables]),
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def town_ids(self):
+        return np.repeat(np.arange(len(self), dtype=np.int32), np.diff(self.offsets))
+
+    @property
+    def nations(self):
+        return [self.nation_names[code] if code >= 0 else None for code in self.nation_codes]
+
+    def town_blocks(self, index):
+        return self.blocks[self.offsets[index]:self.offsets[index + 1]]
+
+    def summary(self, index):
+        home_block = self.home_blocks[index]
+        return {
+            'name': self.names[index],
+            'nation': self.nation_names[self.nation_codes[index]] if self.nation_codes[index] >= 0 else None,
+            'mayor': self.mayors[index],
+            'home_block': None if np.isnan(home_block).any() else [int(value) for value in home_block],
+            **{key: int(values[index]) for key, values in self.stats.items()},
+        }
+
+    def set_mayor_last_online(self, last_online):
+        self.mayor_last_online = np.array([last_online.get(mayor) for mayor in self.mayors], dtype=np.float64)
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[:-1][indices]
+        counts = self.offsets[1:][indices] - starts
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        block_index = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - starts, counts)
+
+        return TownTable(
+            names=self.names[indices],
+            mayors=self.mayors[indices],
+            nation_codes=self.nation_codes[indices],
+            nation_names=self.nation_names,
+            stats={key: values[indices] for key, values in self.stats.items()},
+            status={key: values[indices] for key, values in self.status.items()},
+            home_blocks=self.home_blocks[indices],
+            blocks=self.blocks[block_index],
+            offsets=offsets,
+            mayor_last_online=self.mayor_last_online[indices],
+        )
+
+    def filter(self, predicate):
+        # predicate is a boolean mask over towns or a callable returning one for this table
+        mask = predicate(self) if callable(predicate) else predicate
+        return self.take(np.flatnonzero(mask))
+
+    def by_nation(self, nation_names):
+        return self.filter(self.nation_mask(nation_names))
+
+    def by_name(self, town_names):
+        return self.filter(self.name_mask(town_names))
+
+    def name_mask(self, town_names):
+        wanted = {name.lower() for name in town_names}
+        return np.array([name.lower() in wanted for name in self.names], dtype=bool)
+
+    def nation_mask(self, nation_names):
+        wanted = {name.lower() for name in nation_names}
+        codes = [code for code, name in enumerate(self.nation_names) if name.lower() in wanted]
+        return np.isin(self.nation_codes, codes)
+
+    def select(self, nation_names=(), town_names=()):
+        # Towns in any of the nations plus the individually named towns, like a live fetch would return
+        return self.filter(self.nation_mask(nation_names) | self.name_mask(town_names))
+
+def block_array(town_blocks):
+    # fromiter skips numpy's per-element sequence checks, which dominate for towns with thousands of blocks
+    if isinstance(town_blocks, np.ndarray):
+        return town_blocks.astype(np.int32, copy=False).reshape(-1, 2)
+    return np.fromiter(chain.from_iterable(town_blocks), dtype=np.int32, count=2 * len(town_blocks)).reshape(-1, 2)
+
+def compact_town(town):
+    # Only the fields the renderers and color modes use, with the blocks already packed
+    return {
+        'name': sys.intern(town['name']),
+        'nation': {'name': (town.get('nation') or {}).get('name')},
+        'mayor': {'name': sys.intern(town['mayor']['name'])},
+        'coordinates': {
+            'townBlocks': block_array(town['coordinates']['townBlocks']),
+            'homeBlock': town['coordinates']['homeBlock'],
+        },
+        'stats': {key: town['stats'][key] for key in STAT_KEYS},
+        'status': {key: town['status'][key] for key in STATUS_KEYS},
+    }
+
+def changed_towns(table, previous):
+    # Towns that are new or differ from previous in stats, status, claims, homeblock, nation or mayor,
+    # and the index of each town's row in previous (-1 when it is new)
+    previous_index = {name: i for i, name in enumerate(previous.names)}
+    indices = np.array([previous_index.get(name, -1) for name in table.names], dtype=np.int64)
+    if len(previous) == 0:
+        return np.ones(len(table), dtype=bool), indices
+
+    rows = np.maximum(indices, 0)
+    changed = indices < 0
+    for key in STAT_KEYS:
+        changed |= table.stats[key] != previous.stats[key][rows]
+    for key in STATUS_KEYS:
+        changed |= table.status[key] != previous.status[key][rows]
+    changed |= np.diff(table.offsets) != np.diff(previous.offsets)[rows]
+    changed |= block_fingerprints(table) != block_fingerprints(previous)[rows]
+    changed |= ~np.all((table.home_blocks == previous.home_blocks[rows])
+                       | (np.isnan(table.home_blocks) & np.isnan(previous.home_blocks[rows])), axis=1)
+    changed |= np.array(table.nations, dtype=object) != np.array(previous.nations, dtype=object)[rows]
+    changed |= table.mayors != previous.mayors[rows]
+    return changed, indices
+
+def pack_blocks(blocks):
+    # One int64 key per (x, y) block, so block sets can be sorted, searched and diffed as flat arrays
+    blocks = np.asarray(blocks, dtype=np.int64).reshape(-1, 2)
+    return (blocks[:, 0] << 32) | (blocks[:, 1] & 0xffffffff)
+
+def block_fingerprints(table):
+    # Order-independent hash of each town's blocks, so claims that moved without changing count are noticed
+    keys = pack_blocks(table.blocks).view(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    keys ^= keys >> np.uint64(29)
+    fingerprints = np.zeros(len(table), dtype=np.uint64)
+    np.add.at(fingerprints, table.town_ids, keys)
+    return fingerprints
+
+def contains_keys(sorted_keys, keys):
+    # np.isin for packed block keys against an already sorted array, a binary search per key
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return sorted_keys[positions] == keys
+
+class BlockIndex:
+    def __init__(self, table):
+        self.table = table
+        self.chunk_cells = None
+
+        # A direct table: chunk_slots maps every chunk in the bounding box to its row of chunk_cells,
+        # which holds the owner of each block in the chunk. Unclaimed chunks share the last, empty row
+        blocks = table.blocks.astype(np.int64)
+        if len(blocks):
+            chunks = blocks >> INDEX_CHUNK_BITS
+            self.chunk_origin = tuple(int(value) for value in chunks.min(axis=0))
+            self.chunk_span = tuple(int(value) for value in chunks.max(axis=0) - self.chunk_origin + 1)
+            chunks -= self.chunk_origin
+            occupied, slots = np.unique(chunks[:, 1] * self.chunk_span[0] + chunks[:, 0], return_inverse=True)
+            side = 1 << INDEX_CHUNK_BITS
+            if self.chunk_span[0] * self.chunk_span[1] + (len(occupied) + 1) * side * side <= INDEX_TABLE_MAX_CELLS:
+                self.chunk_slots = np.full(self.chunk_span[0] * self.chunk_span[1], len(occupied), dtype=np.int32)
+                self.chunk_slots[occupied] = np.arange(len(occupied), dtype=np.int32)
+                self.chunk_cells = np.full((len(occupied) + 1, side * side), -1, dtype=np.int32)
+                local = blocks & (side - 1)
+                self.chunk_cells[slots.reshape(-1), (local[:, 1] << INDEX_CHUNK_BITS) | local[:, 0]] = table.town_ids
+        if self.chunk_cells is None:
+            keys = pack_blocks(blocks)
+            order = np.argsort(keys, kind='stable')
+            self.keys = keys[order]
+            self.owners = table.town_ids[order]
+
+        # Per-town bounding boxes (min_x, min_y, max_x, max_y); towns without blocks never match
+        counts = np.diff(table.offsets)
+        has_blocks = counts > 0
+        starts = table.offsets[:-1][has_blocks]
+        self.bounds = np.empty((len(table), 4), dtype=np.int64)
+        self.bounds[:, :2] = np.iinfo(np.int32).max
+        self.bounds[:, 2:] = np.iinfo(np.int32).min
+        if len(starts):
+            for column, reduce, axis in ((0, np.minimum, 0), (1, np.minimum, 1), (2, np.maximum, 0), (3, np.maximum, 1)):
+                self.bounds[has_blocks, column] = reduce.reduceat(table.blocks[:, axis], starts)
+
+    def towns_at(self, xs, ys):
+        # Town index owning each (x, y) block, -1 where the block is unclaimed
+        if self.chunk_cells is not None:
+            xs, ys = np.asarray(xs, dtype=np.int64).reshape(-1), np.asarray(ys, dtype=np.int64).reshape(-1)
+            chunk_x = (xs >> INDEX_CHUNK_BITS) - self.chunk_origin[0]
+            chunk_y = (ys >> INDEX_CHUNK_BITS) - self.chunk_origin[1]
+            inside = (chunk_x >= 0) & (chunk_x < self.chunk_span[0]) & (chunk_y >= 0) & (chunk_y < self.chunk_span[1])
+            slots = np.where(inside, self.chunk_slots[np.where(inside, chunk_y * self.chunk_span[0] + chunk_x, 0)],
+                             len(self.chunk_cells) - 1)
+            mask = (1 << INDEX_CHUNK_BITS) - 1
+            return self.chunk_cells[slots, ((ys & mask) << INDEX_CHUNK_BITS) | (xs & mask)].astype(np.int64)
+
+        keys = pack_blocks(np.column_stack([xs, ys]))
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[positions] == keys, self.owners[positions], -1)
+
+    def town_at(self, x, y):
+        if self.chunk_cells is None:
+            return int(self.towns_at([x], [y])[0])
+        # Plain integer arithmetic, a single lookup is cheaper without building arrays
+        x, y = int(x), int(y)
+        chunk_x = (x >> INDEX_CHUNK_BITS) - self.chunk_origin[0]
+        chunk_y = (y >> INDEX_CHUNK_BITS) - self.chunk_origin[1]
+        if not (0 <= chunk_x < self.chunk_span[0] and 0 <= chunk_y < self.chunk_span[1]):
+            return -1
+        mask = (1 << INDEX_CHUNK_BITS) - 1
+        slot = self.chunk_slots[chunk_y * self.chunk_span[0] + chunk_x]
+        return int(self.chunk_cells[slot, ((y & mask) << INDEX_CHUNK_BITS) | (x & mask)])
+
+    def towns_in_rect(self, min_x, min_y, max_x, max_y):
+        # Town indices with at least one block inside the rectangle, bounds inclusive
+        bounds = self.bounds
+        overlaps = (bounds[:, 0] <= max_x) & (bounds[:, 2] >= min_x) & (bounds[:, 1] <= max_y) & (bounds[:, 3] >= min_y)
+        inside = overlaps & (bounds[:, 0] >= min_x) & (bounds[:, 2] <= max_x) & (bounds[:, 1] >= min_y) & (bounds[:, 3] <= max_y)
+
+        # Towns whose bounding box is only partly inside need their blocks checked
+        partial = np.flatnonzero(overlaps & ~inside)
+        blocks = self.table.take(partial).blocks
+        hit = (blocks[:, 0] >= min_x) & (blocks[:, 0] <= max_x) & (blocks[:, 1] >= min_y) & (blocks[:, 1] <= max_y)
+        owners = np.repeat(partial, np.diff(self.table.offsets)[partial])[hit]
+
+        return np.union1d(np.flatnonzero(inside), owners)
+
+def save_snapshot(table, path):
+    # One .npy file per column so load_snapshot can memory-map the large ones
+    arrays = {
+        'blocks': table.blocks,
+        'offsets': table.offsets,
+        'nation_codes': table.nation_codes,
+        'home_blocks': table.home_blocks,
+        'mayor_last_online': table.mayor_last_online,
+    }
+    arrays.update({f'stats.{key}': values for key, values in table.stats.items()})
+    arrays.update({f'status.{key}': values for key, values in table.status.items()})
+
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), np.ascontiguousarray(values))
+    with open(os.path.join(tmp_path, 'names.json'), 'w') as f:
+        json.dump({'names': list(table.names), 'mayors': list(table.mayors), 'nation_names': table.nation_names}, f)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({'version': SNAPSHOT_VERSION, 'created': time.time(), 'towns': len(table), 'blocks': len(table.blocks)}, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+def read_snapshot_meta(path):
+    with open(os.path.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+def load_snapshot(path, mmap=True):
+    meta = read_snapshot_meta(path)
+    if meta['version'] != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {meta['version']} in {path}")
+    with open(os.path.join(path, 'names.json')) as f:
+        names = json.load(f)
+
+    def load(name):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None)
+
+    return TownTable(
+        names=np.array([sys.intern(name) for name in names['names']], dtype=object),
+        mayors=np.array([sys.intern(name) for name in names['mayors']], dtype=object),
+        nation_codes=load('nation_codes'),
+        nation_names=[sys.intern(name) for name in names['nation_names']],
+        stats={key: load(f'stats.{key}') for key in STAT_KEYS},
+        status={key: load(f'status.{key}') for key in STATUS_KEYS},
+        home_blocks=load('home_blocks'),
+        blocks=load('blocks'),
+        offsets=load('offsets'),
+        mayor_last_online=load('mayor_last_online'),
+    )
+
+class HistoryStore:
+    # Periodic world states in one directory: a full snapshot every keyframe_every entries and, in between,
+    # snapshots of only the towns that changed plus the names of towns that disappeared
+    def __init__(self, path, keyframe_every=HISTORY_KEYFRAME_EVERY):
+        self.path = path
+        self.keyframe_every = keyframe_every
+        self.lock = threading.Lock()
+        self.loaded = TTLCache(HISTORY_CACHE_TTL, HISTORY_CACHE_SIZE)
+        self.latest = None
+        try:
+            with open(os.path.join(path, 'index.json')) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = []
+
+    def entry_path(self, entry):
+        return os.path.join(self.path, str(entry['timestamp']))
+
+    def write_index(self):
+        tmp_path = os.path.join(self.path, 'index.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, os.path.join(self.path, 'index.json'))
+
+    def append(self, table, timestamp=None):
+        timestamp = int(timestamp or time.time())
+        with self.lock:
+            if self.entries and timestamp <= self.entries[-1]['timestamp']:
+                raise ValueError(f"History entry {timestamp} is not newer than {self.entries[-1]['timestamp']}")
+
+            previous = self.latest if self.latest is not None else self.load_locked(self.entries[-1]['timestamp']) if self.entries else None
+            keyframes = [i for i, entry in enumerate(self.entries) if entry['kind'] == 'key']
+            entry = {'timestamp': timestamp, 'towns': len(table), 'blocks': len(table.blocks)}
+
+            if previous is None or len(self.entries) - keyframes[-1] >= self.keyframe_every:
+                save_snapshot(table, self.entry_path(entry))
+                entry['kind'] = 'key'
+            else:
+                changed, _ = changed_towns(table, previous)
+                save_snapshot(table.filter(changed), self.entry_path(entry))
+                entry.update(kind='delta', changed=int(changed.sum()), removed=sorted(set(previous.names) - set(table.names)))
+
+            self.entries.append(entry)
+            self.write_index()
+            self.latest = table
+            return entry
+
+    def load(self, timestamp):
+        # The state at the newest entry taken at or before timestamp, or None if there is none
+        with self.lock:
+            return self.load_locked(timestamp)
+
+    def load_locked(self, timestamp):
+        position = bisect.bisect_right([entry['timestamp'] for entry in self.entries], timestamp) - 1
+        if position < 0:
+            return None
+
+        table = self.loaded.get(self.entries[position]['timestamp'])
+        if table is not None:
+            return table
+
+        start = max(i for i in range(position + 1) if self.entries[i]['kind'] == 'key')
+        table = load_snapshot(self.entry_path(self.entries[start]), mmap=False)
+        for entry in self.entries[start + 1:position + 1]:
+            delta = load_snapshot(self.entry_path(entry), mmap=False)
+            replaced = set(entry['removed']) | set(delta.names)
+            table = TownTable.concat([table.filter(np.array([name not in replaced for name in table.names], dtype=bool)), delta])
+
+        self.loaded.set(self.entries[position]['timestamp'], table)
+        return table
+
+def claim_changes(before, after):
+    # One row per change kind owning its blocks, then every town in after without blocks so homeblocks still draw
+    before_keys = pack_blocks(before.blocks)
+    after_keys = pack_blocks(after.blocks)
+    kept = contains_keys(np.sort(before_keys), after_keys)
+    lost = ~contains_keys(np.sort(after_keys), before_keys)
+    groups = [after.blocks[kept], after.blocks[~kept], before.blocks[lost]]
+
+    blocks = np.concatenate(groups)
+    kinds = len(CLAIM_CHANGE_COLORS)
+    return TownTable(
+        names=np.array(list(CLAIM_CHANGE_COLORS) + list(after.names), dtype=object),
+        mayors=np.concatenate([np.full(kinds, None, dtype=object), after.mayors]),
+        nation_codes=np.concatenate([np.full(kinds, -1, dtype=np.int32), after.nation_codes]),
+        nation_names=after.nation_names,
+        stats={key: np.concatenate([np.zeros(kinds, dtype=np.int32), values]) for key, values in after.stats.items()},
+        status={key: np.concatenate([np.zeros(kinds, dtype=bool), values]) for key, values in after.status.items()},
+        home_blocks=np.concatenate([np.full((kinds, 2), np.nan), after.home_blocks]),
+        blocks=blocks,
+        offsets=np.concatenate([[0], np.cumsum([len(group) for group in groups]), np.full(len(after), len(blocks))]),
+        mayor_last_online=np.concatenate([np.full(kinds, np.nan), after.mayor_last_online]),
+    )
+
+class TTLCache:
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'hit_rate': self.hits / lookups if lookups else 0.0}
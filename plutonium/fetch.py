@@ -0,0 +1,346 @@
+import asyncio
+import atexit
+import contextvars
+import json
+import random
+import threading
+import time
+from itertools import chain
+
+from .data import TTLCache, TownTable, compact_town
+from .metrics import metrics, request_timings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Towns are only streamed with ijson's C backend, its pure Python ones parse far slower than orjson or json
+STREAM_TOWNS = ijson is not None and ijson.backend == 'yajl2_c'
+# A 200 whose body is not the JSON expected, raised by json, orjson, ijson or the parse callbacks
+DECODE_ERRORS = (ValueError, KeyError, TypeError) + ((ijson.JSONError,) if ijson is not None else ())
+
+API_NATIONS = "https://api.earthmc.net/v3/aurora/nations"
+API_TOWNS = "https://api.earthmc.net/v3/aurora/towns"
+API_PLAYERS = "https://api.earthmc.net/v3/aurora/players"
+
+MAX_CONCURRENCY = 10  # Concurrent EarthMC API requests per process
+RATE_LIMIT = 10  # Sustained requests per second to the EarthMC API
+RATE_BURST = 20
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5  # Seconds, doubled on every retry
+BACKOFF_MAX = 30
+REQUEST_TIMEOUT = 30
+MAX_QUERY_SIZE = 100  # Names the EarthMC API accepts in one query
+
+NATION_CACHE_TTL = 600  # Seconds
+TOWN_CACHE_TTL = 300
+PLAYER_CACHE_TTL = 300
+NATION_CACHE_SIZE = 1000
+TOWN_CACHE_SIZE = 50000
+PLAYER_CACHE_SIZE = 50000
+
+# An object with update(planned, done), told about EarthMC batches as they are planned and as they arrive
+fetch_progress = contextvars.ContextVar('fetch_progress', default=None)
+
+class EarthMCAPIError(Exception):
+    pass
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        # Only ever awaited on the fetch loop, so no lock is needed
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def loads_json(body):
+    return orjson.loads(body) if orjson is not None else json.loads(body)
+
+async def read_json(response):
+    return loads_json(await response.read())
+
+async def read_towns(response):
+    # When streaming each town is compacted as soon as it has arrived, so a batch never exists as full JSON
+    if STREAM_TOWNS:
+        return [compact_town(town) async for town in ijson.items_async(response.content, 'item', use_float=True)]
+    return [compact_town(town) for town in loads_json(await response.read())]
+
+class EarthMCClient:
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, rate=RATE_LIMIT, burst=RATE_BURST,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF_BASE, max_backoff=BACKOFF_MAX, timeout=REQUEST_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.session = None
+        self.semaphore = None
+
+        self.rate_limiter = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def get_session(self):
+        # aiohttp is imported with the first session, so processes that never fetch skip it
+        import aiohttp
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+            self.session = aiohttp.ClientSession(connector=connector, headers={"Content-Type": "application/json"},
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.session
+
+    async def post(self, url, query, parse=None):
+        return await self.request('POST', url, {"query": query}, parse)
+
+    async def get(self, url, parse=None):
+        return await self.request('GET', url, parse=parse)
+
+    async def request(self, method, url, payload=None, parse=None):
+        # parse turns a 200 response into data while the body is still streaming, read_json by default
+        import aiohttp
+        parse = parse or read_json
+        session = self.get_session()
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+            async with self.semaphore:
+                start = time.perf_counter()
+                try:
+                    async with session.request(method, url, json=payload) as response:
+                        status = response.status
+                        retry_after = response.headers.get('Retry-After')
+                        if status == 200:
+                            data = await parse(response)
+                except (aiohttp.ClientError, asyncio.TimeoutError) + DECODE_ERRORS as e:
+                    # Undecodable bodies are retried too, a stream cut short fails here rather than in aiohttp
+                    self.record(url, time.perf_counter() - start, attempt, failed=True)
+                    if attempt == self.max_retries:
+                        raise EarthMCAPIError(f"{url}: {e!r}") from e
+                    await asyncio.sleep(self.retry_delay(attempt))
+                    continue
+
+            self.record(url, time.perf_counter() - start, attempt, failed=status != 200)
+            metrics.count('earthmc_responses', endpoint=url.rsplit('/', 1)[-1], status=status)
+            if status == 200:
+                return data
+            if not (status == 429 or status >= 500) or attempt == self.max_retries:
+                raise EarthMCAPIError(f"{url} returned HTTP {status}")
+            await asyncio.sleep(self.retry_delay(attempt, retry_after))
+
+    def retry_delay(self, attempt, retry_after=None):
+        # Exponential backoff with full jitter, never shorter than the server's Retry-After
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        return delay
+
+    def record(self, url, seconds, attempt, failed=False):
+        if attempt > 0:
+            metrics.count('earthmc_retries', endpoint=url.rsplit('/', 1)[-1])
+        with self.stats_lock:
+            stats = self.stats.setdefault(url, {'requests': 0, 'retries': 0, 'failures': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            stats['requests'] += 1
+            stats['retries'] += attempt > 0
+            stats['failures'] += failed
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    def latency_stats(self):
+        with self.stats_lock:
+            return {url: dict(stats, avg_seconds=stats['total_seconds'] / stats['requests'])
+                    for url, stats in self.stats.items()}
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+api_client = EarthMCClient()
+
+fetch_loop = None
+fetch_loop_lock = threading.Lock()
+
+def get_fetch_loop():
+    # One event loop thread per process: every caller shares its session, rate limiter and concurrency limit
+    global fetch_loop
+    with fetch_loop_lock:
+        if fetch_loop is None:
+            fetch_loop = asyncio.new_event_loop()
+            threading.Thread(target=fetch_loop.run_forever, name='earthmc-fetch', daemon=True).start()
+            atexit.register(lambda: asyncio.run_coroutine_threadsafe(api_client.close(), fetch_loop).result(5))
+        return fetch_loop
+
+def run_sync(coro):
+    # The coroutine runs on the fetch loop thread, so carry the caller's request timings and progress over to it
+    timings = request_timings.get()
+    progress = fetch_progress.get()
+
+    async def with_timings():
+        request_timings.set(timings)
+        fetch_progress.set(progress)
+        return await coro
+
+    return asyncio.run_coroutine_threadsafe(with_timings(), get_fetch_loop()).result()
+
+nation_cache = TTLCache(NATION_CACHE_TTL, NATION_CACHE_SIZE)
+town_cache = TTLCache(TOWN_CACHE_TTL, TOWN_CACHE_SIZE)
+player_cache = TTLCache(PLAYER_CACHE_TTL, PLAYER_CACHE_SIZE)
+
+def cache_stats():
+    return {'nations': nation_cache.stats(), 'towns': town_cache.stats(), 'players': player_cache.stats()}
+
+def split_cached(names, cache):
+    cached = []
+    missing = []
+    for name in names:
+        value = cache.get(name.lower())
+        if value is None:
+            missing.append(name)
+        else:
+            cached.append(value)
+    return cached, missing
+
+def batch_requests(data_list, batch_size=MAX_QUERY_SIZE):
+    for i in range(0, len(data_list), batch_size):
+        yield data_list[i:i + batch_size]
+
+def unique_names(names):
+    # Stripped names, deduplicated case-insensitively in their original order
+    unique = {}
+    for name in names:
+        name = name.strip()
+        if name:
+            unique.setdefault(name.lower(), name)
+    return list(unique.values())
+
+def split_names(names):
+    return unique_names((names or '').split(','))
+
+name_resolution = {kind: {'names': 0, 'duplicates': 0, 'cached': 0, 'requests': 0, 'requests_saved': 0}
+                   for kind in ('nations', 'towns', 'players')}
+name_resolution_lock = threading.Lock()
+
+def resolve_names(kind, names, cache):
+    # Dedupes before the cache lookup and batching, so every query sent is a full one of unique uncached names
+    names = list(names)
+    unique = unique_names(names)
+    cached, missing = split_cached(unique, cache)
+    batches = list(batch_requests(missing))
+
+    metrics.count('cache_hits', len(cached), cache=kind)
+    metrics.count('cache_misses', len(missing), cache=kind)
+    metrics.count('earthmc_batches', len(batches), endpoint=kind)
+    with name_resolution_lock:
+        stats = name_resolution[kind]
+        stats['names'] += len(names)
+        stats['duplicates'] += len(names) - len(unique)
+        stats['cached'] += len(cached)
+        stats['requests'] += len(batches)
+        stats['requests_saved'] += -(-len(names) // MAX_QUERY_SIZE) - len(batches)
+    report_fetch_progress(planned=len(batches))
+    return cached, batches
+
+def report_fetch_progress(planned=0, done=0):
+    progress = fetch_progress.get()
+    if progress is not None:
+        progress.update(planned, done)
+
+def name_resolution_stats():
+    with name_resolution_lock:
+        return {kind: dict(stats) for kind, stats in name_resolution.items()}
+
+async def fetch_all_town_names():
+    return [town['name'] for town in await api_client.get(API_TOWNS)]
+
+async def fetch_nation_towns(nations):
+    cached, batches = resolve_names('nations', nations, nation_cache)
+    all_town_names = list(chain.from_iterable(cached))
+
+    for town_names in await asyncio.gather(*(fetch_nation_batch(batch) for batch in batches)):
+        all_town_names.extend(town_names)
+
+    return all_town_names
+
+async def fetch_nation_batch(nation_batch):
+    with metrics.span('fetch', endpoint='nations'):
+        nation_data = await api_client.post(API_NATIONS, nation_batch)
+    report_fetch_progress(done=1)
+    town_names = []
+    if nation_data:
+        for nation in nation_data:
+            nation_towns = [town['name'] for town in nation['towns']]
+            nation_cache.set(nation['name'].lower(), nation_towns)
+            town_names.extend(nation_towns)
+    return town_names
+
+async def fetch_town_data(town_names):
+    cached, batches = resolve_names('towns', town_names, town_cache)
+
+    async def with_mayors(towns):
+        return towns, await fetch_player_data([town['mayor']['name'] for town in towns])
+
+    async def fetch_town_batch_with_mayors(town_batch):
+        # Mayor lookups for a batch start as soon as that batch arrives
+        return await with_mayors(await fetch_town_batch(town_batch))
+
+    results = await asyncio.gather(with_mayors(cached),
+                                   *(fetch_town_batch_with_mayors(batch) for batch in batches))
+
+    table = TownTable.from_json(list(chain.from_iterable(towns for towns, _ in results)))
+    mayor_data = {}
+    for _, players in results:
+        mayor_data.update(players)
+    table.set_mayor_last_online({name: player['timestamps']['lastOnline'] for name, player in mayor_data.items()})
+    return table
+
+async def fetch_town_batch(town_batch):
+    with metrics.span('fetch', endpoint='towns'):
+        towns = await api_client.post(API_TOWNS, town_batch, parse=read_towns)
+    report_fetch_progress(done=1)
+    metrics.count('towns_fetched', len(towns))
+    metrics.count('blocks_fetched', sum(len(town['coordinates']['townBlocks']) for town in towns))
+    for town in towns:
+        town_cache.set(town['name'].lower(), town)
+    return towns
+
+async def fetch_player_data(player_names):
+    cached, batches = resolve_names('players', player_names, player_cache)
+    all_player_data = {player['name']: player for player in cached}
+
+    for player_data in await asyncio.gather(*(fetch_player_batch(batch) for batch in batches)):
+        all_player_data.update(player_data)
+
+    return all_player_data
+
+async def fetch_player_batch(player_batch):
+    with metrics.span('fetch', endpoint='players'):
+        players = await api_client.post(API_PLAYERS, player_batch)
+    report_fetch_progress(done=1)
+    data = [{'name': player['name'], 'timestamps': {'lastOnline': player['timestamps'].get('lastOnline')}} for player in players]
+    for player in data:
+        player_cache.set(player['name'].lower(), player)
+    return {player['name']: player for player in data}
+
+def get_nation_towns(nation_names):
+    return run_sync(fetch_nation_towns([name.strip() for name in nation_names.split(',')]))
+
+def get_town_data(town_names):
+    return run_sync(fetch_town_data(town_names))
+
+def get_player_data(player_names):
+    return run_sync(fetch_player_data(player_names))
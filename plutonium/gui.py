@@ -0,0 +1,251 @@
+import threading
+
+import numpy as np
+import tkinter as tk
+from tkinter import ttk, messagebox, filedialog
+
+from .data import BlockIndex, load_snapshot, save_snapshot
+from .fetch import EarthMCAPIError, get_nation_towns, get_town_data, unique_names
+from .render import COLOR_MODES, build_palette, draw_home_blocks, draw_map_axes, rasterize_map, town_colors
+
+class TownMapApp(tk.Tk):
+    def __init__(self):
+        super().__init__()
+        self.title("EarthMC Plutonium Map")
+        self.geometry("1200x800")
+        self.configure(bg='#1e1e1e')
+
+        self.style = ttk.Style(self)
+        self.style.theme_use('clam')
+        self.configure_styles()
+
+        self.slider_value = 250  
+
+        self.town_data = None
+        self.snapshot = None
+        self.map_canvas = None
+        self.map_figure = None
+        self.map_clusters = []
+        self.map_images = []
+        self.home_block_markers = None
+        self.block_index = None
+
+        self.create_widgets()
+
+    def configure_styles(self):
+        self.style.configure('TFrame', background='#1e1e1e')
+        self.style.configure('TLabel', background='#1e1e1e', foreground='#ffffff', font=('Helvetica', 12))
+        self.style.configure('TEntry', fieldbackground='#2c2c2c', foreground='#ffffff', font=('Helvetica', 12))
+        self.style.configure('TButton', font=('Helvetica', 12, 'bold'), background='#4CAF50', foreground='#ffffff')
+        self.style.configure('TCheckbutton', background='#1e1e1e', foreground='#ffffff', font=('Helvetica', 12))
+        self.style.map('TCheckbutton', background=[('active', '#1e1e1e')])
+
+        self.style.configure('Generate.TButton', background='#4CAF50', foreground='#ffffff')
+        self.style.map('Generate.TButton', 
+                       background=[('active', '#45a049'), ('pressed', '#3d8b40')],
+                       foreground=[('pressed', '#ffffff')])
+
+    def create_widgets(self):
+        self.main_frame = ttk.Frame(self, padding="20")
+        self.main_frame.pack(fill=tk.BOTH, expand=True)
+
+        self.main_frame.columnconfigure(1, weight=1)
+        self.main_frame.rowconfigure(1, weight=1)
+
+        ttk.Label(self.main_frame, text="Plutonium Map", font=('Helvetica', 24, 'bold'), foreground='#4CAF50').grid(row=0, column=0, columnspan=2, pady=(0, 20))
+
+        self.create_input_frame()
+        self.create_map_frame()
+
+    def create_input_frame(self):
+        input_frame = ttk.Frame(self.main_frame, padding="10")
+        input_frame.grid(row=1, column=0, sticky='nsew')
+
+        ttk.Label(input_frame, text="Nation Name(s):").grid(row=0, column=0, sticky=tk.W, pady=5)
+        self.nation_entry = ttk.Entry(input_frame, width=30)
+        self.nation_entry.grid(row=0, column=1, sticky=tk.W, pady=5)
+
+        ttk.Label(input_frame, text="Individual Town(s):").grid(row=1, column=0, sticky=tk.W, pady=5)
+        self.town_entry = ttk.Entry(input_frame, width=30)
+        self.town_entry.grid(row=1, column=1, sticky=tk.W, pady=5)
+
+        self.show_home_blocks = tk.BooleanVar(value=True)
+        self.home_blocks_check = ttk.Checkbutton(input_frame, text="Show Home Blocks", variable=self.show_home_blocks, command=self.toggle_home_blocks)
+        self.home_blocks_check.grid(row=2, column=0, columnspan=2, sticky=tk.W, pady=5)
+
+        self.color_mode = tk.StringVar(value='random')
+        ttk.Label(input_frame, text="Color Mode:").grid(row=3, column=0, sticky=tk.W, pady=5)
+        self.color_mode_combo = ttk.Combobox(input_frame, textvariable=self.color_mode, 
+                                         values=list(COLOR_MODES), 
+                                         state='readonly')
+        self.color_mode_combo.grid(row=3, column=1, sticky=tk.W, pady=5)
+        self.color_mode_combo.bind('<<ComboboxSelected>>', lambda e: self.update_colors())
+
+        ttk.Label(input_frame, text="Homeblock Star Size:").grid(row=4, column=0, sticky=tk.W, pady=5)
+        self.star_size_slider = ttk.Scale(input_frame, from_=50, to=500, orient=tk.HORIZONTAL)
+        self.star_size_slider.set(self.slider_value)  
+        self.star_size_slider.grid(row=4, column=1, sticky=tk.W, pady=5)
+        self.star_size_slider.bind('<ButtonRelease-1>', self.on_slider_release)  
+
+        self.generate_button = ttk.Button(input_frame, text="Generate Map", command=self.run_generate_map_thread, style='Generate.TButton')
+        self.generate_button.grid(row=5, column=0, columnspan=2, pady=10)
+
+        ttk.Button(input_frame, text="Load Snapshot", command=self.load_snapshot).grid(row=6, column=0, sticky=tk.W, pady=5)
+        ttk.Button(input_frame, text="Save Snapshot", command=self.save_snapshot).grid(row=6, column=1, sticky=tk.W, pady=5)
+
+        self.use_snapshot = tk.BooleanVar(value=False)
+        self.use_snapshot_check = ttk.Checkbutton(input_frame, text="Render From Snapshot", variable=self.use_snapshot, state='disabled')
+        self.use_snapshot_check.grid(row=7, column=0, columnspan=2, sticky=tk.W, pady=5)
+
+    def create_map_frame(self):
+        self.map_frame = ttk.Frame(self.main_frame, padding="10")
+        self.map_frame.grid(row=1, column=1, sticky='nsew')
+        self.map_frame.columnconfigure(0, weight=1)
+        self.map_frame.rowconfigure(0, weight=1)
+
+        self.town_info = tk.StringVar(value="")
+        ttk.Label(self.map_frame, textvariable=self.town_info).grid(row=1, column=0, sticky=tk.W, pady=(5, 0))
+
+    def update_map(self):
+        # Rasterizes new town data once; color and star size changes only update the artists below, and the canvas
+        # widget resizes the figure itself
+        if self.town_data is None:
+            return
+
+        self.map_clusters, bounds = rasterize_map(self.town_data)
+        self.block_index = BlockIndex(self.town_data)
+        self.town_info.set("Click a town to inspect it.")
+        palette = build_palette(town_colors(self.town_data, self.color_mode.get()))
+
+        if self.map_canvas is None:
+            # matplotlib is imported with the first map rather than at startup, so the window opens sooner
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+            from matplotlib.figure import Figure
+
+            self.map_figure = Figure(figsize=(10, 10), facecolor='#1e1e1e')
+            self.map_canvas = FigureCanvasTkAgg(self.map_figure, master=self.map_frame)
+            self.map_canvas.get_tk_widget().grid(row=0, column=0, sticky='nsew')
+            self.map_canvas.mpl_connect('button_press_event', self.on_map_click)
+
+        self.map_figure.clear()
+        ax = self.map_figure.add_subplot(111)
+        self.map_images = draw_map_axes(ax, self.map_clusters, palette, bounds, 'imshow', self.town_data.home_blocks[:0], self.slider_value)
+        self.home_block_markers = draw_home_blocks(ax, self.town_data.home_blocks, self.slider_value)
+        self.home_block_markers.set_visible(self.show_home_blocks.get())
+        self.map_figure.tight_layout()
+
+        self.map_canvas.draw_idle()
+
+    def update_colors(self):
+        if self.map_canvas is None:
+            return
+
+        palette = build_palette(town_colors(self.town_data, self.color_mode.get()))
+        for image, (grid, _) in zip(self.map_images, self.map_clusters):
+            image.set_data(palette[grid])
+        self.map_canvas.draw_idle()
+
+    def on_map_click(self, event):
+        if event.inaxes is None or event.xdata is None or self.block_index is None:
+            return
+
+        x, y = int(np.floor(event.xdata)), int(np.floor(event.ydata))
+        index = self.block_index.town_at(x, y)
+        if index < 0:
+            self.town_info.set(f"({x}, {y}): Wilderness")
+            return
+
+        town = self.town_data.summary(index)
+        self.town_info.set(f"({x}, {y}): {town['name']} ({town['nation'] or 'No Nation'}) - Mayor: {town['mayor']}, "
+                           f"Residents: {town['numResidents']}, Town Blocks: {town['numTownBlocks']}")
+
+    def toggle_home_blocks(self):
+        if self.map_canvas is None:
+            return
+
+        self.home_block_markers.set_visible(self.show_home_blocks.get())
+        self.map_canvas.draw_idle()
+
+    def run_generate_map_thread(self):
+        threading.Thread(target=self.generate_map, daemon=True).start()
+
+    def generate_map(self):
+        nation_names = self.nation_entry.get()
+        town_names = self.town_entry.get()
+
+        if self.use_snapshot.get() and self.snapshot is not None:
+            self.generate_map_from_snapshot(nation_names, town_names)
+            return
+        
+        if not nation_names and not town_names:
+            self.after(0, lambda: messagebox.showwarning("Input Error", "Please enter either nation names or individual town names."))
+            return
+
+        try:
+            nation_towns = get_nation_towns(nation_names) if nation_names else []
+            town_names_list = [name.strip() for name in town_names.split(',')] if town_names else []
+            all_town_names = unique_names(nation_towns + town_names_list)
+
+            if not all_town_names:
+                self.after(0, lambda: messagebox.showwarning("Data Error", "No valid town names found."))
+                return
+
+            self.town_data = get_town_data(all_town_names)
+        except EarthMCAPIError as e:
+            message = f"EarthMC API request failed: {e}"
+            self.after(0, lambda: messagebox.showerror("Network Error", message))
+            return
+
+        self.after(0, self.update_map)
+
+    def generate_map_from_snapshot(self, nation_names, town_names):
+        # No network access: select from the loaded snapshot, or show all of it when nothing is entered
+        if not nation_names and not town_names:
+            self.town_data = self.snapshot
+        else:
+            town_data = self.snapshot.select([name.strip() for name in nation_names.split(',')],
+                                             [name.strip() for name in town_names.split(',')])
+            if not town_data:
+                self.after(0, lambda: messagebox.showwarning("Data Error", "No matching towns found in the snapshot."))
+                return
+            self.town_data = town_data
+
+        self.after(0, self.update_map)
+
+    def load_snapshot(self):
+        path = filedialog.askdirectory(title="Load Snapshot")
+        if not path:
+            return
+
+        try:
+            self.snapshot = load_snapshot(path)
+        except (OSError, ValueError, KeyError) as e:
+            messagebox.showerror("Snapshot Error", f"Could not load snapshot: {e}")
+            return
+
+        self.use_snapshot_check.configure(state='normal')
+        self.use_snapshot.set(True)
+        self.town_data = self.snapshot
+        self.update_map()
+
+    def save_snapshot(self):
+        if self.town_data is None:
+            messagebox.showwarning("Snapshot Error", "Generate a map before saving a snapshot.")
+            return
+
+        path = filedialog.asksaveasfilename(title="Save Snapshot", initialfile="snapshot")
+        if not path:
+            return
+
+        try:
+            save_snapshot(self.town_data, path)
+        except OSError as e:
+            messagebox.showerror("Snapshot Error", f"Could not save snapshot: {e}")
+
+    def on_slider_release(self, event):
+        self.slider_value = self.star_size_slider.get()
+        if self.map_canvas is None:
+            return
+
+        self.home_block_markers.set_sizes([self.slider_value])
+        self.map_canvas.draw_idle()
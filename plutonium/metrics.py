@@ -0,0 +1,86 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+TIMING_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds, for span histograms
+
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+class Metrics:
+    # Counters and timing histograms in Prometheus shape; spans are also collected per request when
+    # request_timings holds a list
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = {'count': 0, 'sum': 0.0, 'buckets': [0] * len(TIMING_BUCKETS)}
+            timing['count'] += 1
+            timing['sum'] += seconds
+            for i, bound in enumerate(TIMING_BUCKETS):
+                if seconds <= bound:
+                    timing['buckets'][i] += 1
+
+        timings = request_timings.get()
+        if timings is not None:
+            timings.append((name, labels, seconds))
+
+    @contextmanager
+    def span(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def prometheus(self, gauges=None):
+        # Text exposition format; gauges maps (name, labels) to values owned by the caller, like cache sizes
+        lines = []
+        declared = set()
+
+        def declare(metric, kind):
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f'# TYPE {metric} {kind}')
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                declare(f'plutonium_{name}_total', 'counter')
+                lines.append(f'plutonium_{name}_total{format_labels(labels)} {value}')
+            for (name, labels), timing in sorted(self.timings.items()):
+                metric = f'plutonium_{name}_seconds'
+                declare(metric, 'histogram')
+                for bound, count in zip(TIMING_BUCKETS, timing['buckets']):
+                    lines.append(f'{metric}_bucket{format_labels(labels + (("le", bound),))} {count}')
+                lines.append(f'{metric}_bucket{format_labels(labels + (("le", "+Inf"),))} {timing["count"]}')
+                lines.append(f'{metric}_sum{format_labels(labels)} {timing["sum"]}')
+                lines.append(f'{metric}_count{format_labels(labels)} {timing["count"]}')
+        for (name, labels), value in sorted((gauges or {}).items()):
+            declare(f'plutonium_{name}', 'gauge')
+            lines.append(f'plutonium_{name}{format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}' if labels else ''
+
+def format_timings(timings):
+    # Seconds per span for the X-Timing header, summed over repeats like the batches of one fetch
+    totals = {}
+    for name, labels, seconds in timings:
+        key = '.'.join([name, *(str(value) for value in labels.values())])
+        totals[key] = totals.get(key, 0.0) + seconds
+    return ', '.join(f'{key}={seconds:.3f}' for key, seconds in totals.items())
+
+metrics = Metrics()
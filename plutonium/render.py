@@ -0,0 +1,502 @@
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from .data import CLAIM_CHANGES, CLAIM_CHANGE_COLORS, STAT_KEYS, TownTable, claim_changes, pack_blocks
+from .metrics import metrics, request_timings
+
+# matplotlib is only imported once something is colored or drawn, so processes that never render skip it
+
+COLOR_MODES = ('No Colors', 'random', 'numResidents', 'numTownBlocks', 'numOutlaws', 'numTrusted', 'Overclaimable',
+               'Population Density', 'Snipeable', 'Days Since Last Online', 'Compactness', 'Frontier', 'Foreign Border',
+               'Enclaves', 'Nearest Town')
+# Color modes shaded by a TownAnalytics attribute, computed from the towns' shapes and neighbours
+ANALYTICS_MODES = {'Compactness': 'compactness', 'Frontier': 'frontier_share', 'Foreign Border': 'foreign_border',
+                   'Nearest Town': 'nearest_distance'}
+RENDERERS = ('imshow', 'pcolormesh', 'pillow')
+# pillow frames the map like imshow's figure, fitted and centred inside MAP_MARGIN_PX, and draws the same
+# stars. It still differs in that it has no antialiasing, stars are clipped to the map rather than the axes,
+# and maps larger than the canvas keep each pixel's highest town index instead of the one Agg samples
+MAP_SIZE_PX = 1000  # Same pixel size as the 10x10 inch figure at 100 dpi
+MAP_MARGIN_PX = 15  # tight_layout's padding around the map at 100 dpi
+MAX_MAP_PIXELS = 25000000  # Output size cap, whatever dpi or max_pixels a request asks for
+MAX_CROP_CLUSTERS = 400  # Clusters a cropped map may show, each gets its own view
+MIN_CLUSTER_PX = 32  # Smallest view side on a pillow contact sheet, larger sheets are scaled down when encoded
+CONTACT_SHEET_GAP_PX = 10
+GRID_MODES = ('auto', 'dense', 'chunked')
+DENSE_GRID_MAX_CELLS = 4000000  # Bounding boxes above this are rasterized in chunks when grid_mode is 'auto'
+CHUNK_SIZE = 64  # Town blocks per chunk side
+HOME_BLOCK_COLOR = '#4CAF50'
+HOME_BLOCK_EDGE_COLOR = 'white'
+
+OUTPUT_FORMATS = {'png': 'image/png', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+MAP_DPI = 100  # Figure dpi, and the dpi MAP_SIZE_PX corresponds to for the pillow renderer
+PNG_COMPRESSION = 6  # zlib level 0-9, also scaled to the WebP encoder's 0-6 method
+IMAGE_QUALITY = 90  # Lossy WebP and JPEG quality
+
+SNIPEABLE_IDLE_MS = 28 * 24 * 60 * 60 * 1000  # 28 days in milliseconds
+
+def town_bounds(table):
+    min_x, min_y = (int(value) for value in table.blocks.min(axis=0))
+    max_x, max_y = (int(value) for value in table.blocks.max(axis=0))
+    return min_x, min_y, max_x, max_y
+
+def rasterize_towns(table):
+    blocks = table.blocks
+    min_x, min_y, max_x, max_y = town_bounds(table)
+
+    grid = np.zeros((max_y - min_y + 1, max_x - min_x + 1), dtype=np.int32)
+    grid[blocks[:, 1] - min_y, blocks[:, 0] - min_x] = table.town_ids + 1
+
+    return grid, (min_x, min_y, max_x, max_y)
+
+def rasterize_chunks(table, chunk_size=CHUNK_SIZE):
+    # Only chunks that contain at least one block are allocated, keyed by (chunk_x, chunk_y)
+    blocks = table.blocks
+    chunk_keys = blocks // chunk_size
+    # Unique over packed keys, since np.unique along an axis sorts rows far more slowly
+    _, first, inverse = np.unique(pack_blocks(chunk_keys), return_index=True, return_inverse=True)
+    keys = chunk_keys[first]
+    local = blocks - chunk_keys * chunk_size
+
+    chunks = np.zeros((len(keys), chunk_size, chunk_size), dtype=np.int32)
+    chunks[inverse.reshape(-1), local[:, 1], local[:, 0]] = table.town_ids + 1
+
+    return {(int(chunk_x), int(chunk_y)): chunk for (chunk_x, chunk_y), chunk in zip(keys, chunks)}
+
+def chunk_clusters(chunks):
+    # Flood fill over touching chunks, diagonals included
+    remaining = set(chunks)
+    clusters = []
+    while remaining:
+        stack = [remaining.pop()]
+        members = []
+        while stack:
+            chunk_x, chunk_y = stack.pop()
+            members.append((chunk_x, chunk_y))
+            for neighbour in ((chunk_x + dx, chunk_y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)):
+                if neighbour in remaining:
+                    remaining.remove(neighbour)
+                    stack.append(neighbour)
+        clusters.append(members)
+    return clusters
+
+def rasterize_clusters(table, chunk_size=CHUNK_SIZE):
+    # Dense grids per cluster of occupied chunks, so memory follows the claimed area and not the bounding box
+    chunks = rasterize_chunks(table, chunk_size)
+    clusters = []
+    for members in chunk_clusters(chunks):
+        first_x = min(chunk_x for chunk_x, _ in members)
+        first_y = min(chunk_y for _, chunk_y in members)
+        last_x = max(chunk_x for chunk_x, _ in members)
+        last_y = max(chunk_y for _, chunk_y in members)
+
+        grid = np.zeros(((last_y - first_y + 1) * chunk_size, (last_x - first_x + 1) * chunk_size), dtype=np.int32)
+        for chunk_x, chunk_y in members:
+            top, left = (chunk_y - first_y) * chunk_size, (chunk_x - first_x) * chunk_size
+            grid[top:top + chunk_size, left:left + chunk_size] = chunks[(chunk_x, chunk_y)]
+
+        rows = np.flatnonzero(grid.any(axis=1))
+        columns = np.flatnonzero(grid.any(axis=0))
+        grid = grid[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+        min_x, min_y = first_x * chunk_size + int(columns[0]), first_y * chunk_size + int(rows[0])
+        clusters.append((grid, (min_x, min_y, min_x + grid.shape[1] - 1, min_y + grid.shape[0] - 1)))
+
+    return sorted(clusters, key=lambda cluster: (cluster[1][1], cluster[1][0]))
+
+def flag_colors(flags, color, other_color):
+    import matplotlib.colors as mcolors
+    return np.where(flags[:, None], mcolors.to_rgba(color), mcolors.to_rgba(other_color))
+
+def analytics_values(table, color_mode, towns=None):
+    # What an analytics color mode shades each town by, worked out over table; towns picks out some of them, so a
+    # map of those towns still counts the neighbours around them
+    from .analytics import analyze
+    analytics = analyze(table)
+    values = analytics.enclave_of if color_mode == 'Enclaves' else getattr(analytics, ANALYTICS_MODES[color_mode])
+    return values if towns is None else values[towns]
+
+def town_colors(table, color_mode, values=None):
+    # values overrides the analytics of analytics color modes, see analytics_values
+    import matplotlib.colors as mcolors
+    from matplotlib import colormaps
+
+    count = len(table)
+    stats = table.stats
+    status = table.status
+    current_time = time.time() * 1000  # Current time in milliseconds
+
+    if color_mode == 'No Colors':
+        return np.tile(mcolors.to_rgba('#ffffff'), (count, 1))
+    if color_mode == 'random':
+        hsv = np.column_stack([np.random.random(count), np.full(count, 0.7), np.full(count, 0.9)])
+        return np.column_stack([mcolors.hsv_to_rgb(hsv), np.ones(count)])
+    if color_mode == CLAIM_CHANGES:
+        if list(table.names[:len(CLAIM_CHANGE_COLORS)]) != list(CLAIM_CHANGE_COLORS):
+            raise ValueError(f"The '{CLAIM_CHANGES}' color mode needs a baseline to compare against")
+        colors = np.tile(mcolors.to_rgba('grey'), (count, 1))
+        colors[:len(CLAIM_CHANGE_COLORS)] = [mcolors.to_rgba(color) for color in CLAIM_CHANGE_COLORS.values()]
+        return colors
+    if color_mode == 'Overclaimable':
+        return flag_colors(status['isOverClaimed'] & ~status['hasOverclaimShield'], 'red', 'grey')
+    if color_mode == 'Snipeable':
+        # Towns without a known mayor lastOnline have NaN here and never compare as idle
+        idle = current_time - table.mayor_last_online > SNIPEABLE_IDLE_MS
+        return flag_colors((stats['numResidents'] == 1) & status['isOpen'] & idle, 'yellow', 'grey')
+    if color_mode == 'Enclaves':
+        from .analytics import WILDERNESS
+        enclave_of = analytics_values(table, color_mode) if values is None else values
+        return flag_colors(enclave_of != WILDERNESS, 'red', 'grey')
+
+    if color_mode == 'Population Density':
+        stat_values = stats['numResidents'] / np.maximum(stats['numTownBlocks'], 1)
+    elif color_mode == 'Days Since Last Online':
+        stat_values = (current_time - table.mayor_last_online) / (24 * 60 * 60 * 1000)
+    elif color_mode in STAT_KEYS:
+        stat_values = stats[color_mode]
+    elif color_mode in ANALYTICS_MODES:
+        stat_values = analytics_values(table, color_mode) if values is None else values
+    else:
+        raise ValueError(f"Unknown color mode '{color_mode}'")
+
+    # Towns without a value, say no known mayor lastOnline or no other town to measure to, are grey rather
+    # than the colormap's transparent bad color, which would hide them
+    log_stat_values = np.log1p(stat_values)
+    known = ~np.isnan(log_stat_values)
+    colors = np.tile(mcolors.to_rgba('grey'), (count, 1))
+    if known.any():
+        min_stat, max_stat = log_stat_values[known].min(), log_stat_values[known].max()
+        colors[known] = colormaps['viridis']((log_stat_values[known] - min_stat) / ((max_stat - min_stat) or 1))
+    return colors
+
+def build_palette(colors):
+    import matplotlib.colors as mcolors
+    rgba = np.vstack([mcolors.to_rgba('#1e1e1e'), colors])
+    return np.round(rgba * 255).astype(np.uint8)
+
+def index_palette(palette):
+    # The palette as 8-bit indices into its distinct colors followed by the two star colors, or None when
+    # that takes more than 256 colors
+    import matplotlib.colors as mcolors
+    colors, lut = np.unique(palette, axis=0, return_inverse=True)
+    star_colors = np.round(np.array([mcolors.to_rgba(HOME_BLOCK_COLOR), mcolors.to_rgba(HOME_BLOCK_EDGE_COLOR)]) * 255)
+    colors = np.vstack([colors, star_colors.astype(np.uint8)])
+    if len(colors) > 256:
+        return None
+    return lut.reshape(-1).astype(np.uint8), colors
+
+def downsample_max(region, scale):
+    # Each output cell takes the highest town index in its scale x scale square, so small towns stay visible
+    height = -(-region.shape[0] // scale) * scale
+    width = -(-region.shape[1] // scale) * scale
+    if (height, width) != region.shape:
+        padded = np.zeros((height, width), dtype=region.dtype)
+        padded[:region.shape[0], :region.shape[1]] = region
+        region = padded
+    return region.reshape(height // scale, scale, width // scale, scale).max(axis=(1, 3))
+
+def render_map_image(clusters, palette, bounds, home_blocks=(), star_size=250, indexed=None, size=MAP_SIZE_PX):
+    # With indexed from index_palette the map is drawn as palette indices and returned as a 'P' image,
+    # so it never exists as RGBA and encodes as an 8-bit PNG
+    if indexed is not None:
+        lut, colors = indexed
+        values, mode, background = lut, 'L', int(lut[0])
+    else:
+        values, mode, background = palette, 'RGBA', '#1e1e1e'
+
+    min_x, min_y, max_x, max_y = bounds
+    width, height = max_x - min_x + 1, max_y - min_y + 1
+    fit = max(1, size - 2 * MAP_MARGIN_PX) / max(width, height)
+    # Maps with more blocks than pixels are max-pooled to at most one cell per pixel before the final resize
+    step = max(1, int(np.ceil(1 / fit)))
+    if step == 1 and len(clusters) == 1 and clusters[0][1] == bounds:
+        cells = clusters[0][0]
+    else:
+        # Only the occupied clusters are pooled; the rest of the bounding box stays background
+        cells = np.zeros((-(-height // step), -(-width // step)), dtype=np.int32)
+        for grid, (x0, y0, _, _) in clusters:
+            top, left = (y0 - min_y) % step, (x0 - min_x) % step
+            if top or left:
+                aligned = np.zeros((top + grid.shape[0], left + grid.shape[1]), dtype=grid.dtype)
+                aligned[top:, left:] = grid
+                grid = aligned
+            pooled = downsample_max(grid, step) if step > 1 else grid
+            row, column = (y0 - min_y) // step, (x0 - min_x) // step
+            target = cells[row:row + pooled.shape[0], column:column + pooled.shape[1]]
+            np.maximum(target, pooled, out=target)
+
+    map_width, map_height = max(1, round(width * fit)), max(1, round(height * fit))
+    image = Image.fromarray(values[cells])
+    if image.size != (map_width, map_height):
+        image = image.resize((map_width, map_height), Image.NEAREST)
+    left, top = (size - map_width) // 2, (size - map_height) // 2
+    canvas = Image.new(mode, (size, size), background)
+    canvas.paste(image, (left, top))
+    image = canvas
+
+    if len(home_blocks):
+        with metrics.span('markers'):
+            # Markers keep their point size whatever the zoom, like the figure's, so only positions are scaled
+            sprite, margin = star_sprite(star_size)
+
+            # Stamp every star at once: each homeblock gets the sprite's opaque pixels offset to its position
+            home_blocks = home_blocks[~np.isnan(home_blocks).any(axis=1)]
+            centres = np.rint((home_blocks - (min_x, min_y)) * fit).astype(np.int64) + (left - margin, top - margin)
+            sprite_y, sprite_x = np.nonzero(sprite[:, :, 3])
+            stamp = sprite[sprite_y, sprite_x]
+            if indexed is not None:
+                stamp = np.where((stamp == colors[-2]).all(axis=1), len(colors) - 2, len(colors) - 1).astype(np.uint8)
+            y, x = centres[:, 1:] + sprite_y, centres[:, :1] + sprite_x
+            inside = (x >= left) & (x < left + map_width) & (y >= top) & (y < top + map_height)
+            pixels = np.array(image)
+            pixels[y[inside], x[inside]] = np.broadcast_to(stamp, inside.shape + stamp.shape[1:])[inside]
+            image = Image.fromarray(pixels)
+
+    if indexed is not None:
+        image.putpalette(colors[:, :3].tobytes())
+    return image
+
+def star_sprite(star_size):
+    # Match matplotlib's '*' marker: star_size is the marker area in points^2
+    radius = np.sqrt(star_size) / 2 * 100 / 72
+    margin = int(np.ceil(radius)) + 1
+
+    angles = np.pi / 2 + np.arange(10) * np.pi / 5
+    radii = np.where(np.arange(10) % 2, radius * 0.381966, radius)
+    star = np.column_stack([radii * np.cos(angles), -radii * np.sin(angles)]) + margin
+
+    sprite = Image.new('RGBA', (2 * margin + 1, 2 * margin + 1), (0, 0, 0, 0))
+    ImageDraw.Draw(sprite).polygon([tuple(point) for point in star], fill=HOME_BLOCK_COLOR, outline=HOME_BLOCK_EDGE_COLOR)
+    return np.array(sprite), margin
+
+def draw_home_blocks(ax, home_blocks, star_size):
+    # A single collection for every homeblock, instead of one scatter call per town
+    home_blocks = home_blocks[~np.isnan(home_blocks).any(axis=1)]
+    return ax.scatter(home_blocks[:, 0], home_blocks[:, 1], c=HOME_BLOCK_COLOR, marker='*', s=star_size, edgecolor=HOME_BLOCK_EDGE_COLOR, zorder=5)
+
+def home_blocks_within(home_blocks, bounds):
+    min_x, min_y, max_x, max_y = bounds
+    x, y = home_blocks[:, 0], home_blocks[:, 1]
+    return home_blocks[(x >= min_x) & (x < max_x + 1) & (y >= min_y) & (y < max_y + 1)]
+
+def draw_map_axes(ax, clusters, palette, bounds, renderer, home_blocks, star_size):
+    import matplotlib.colors as mcolors
+    min_x, min_y, max_x, max_y = bounds
+    ax.set_facecolor('#1e1e1e')
+
+    if renderer == 'pcolormesh':
+        cmap = mcolors.ListedColormap(palette / 255)
+        norm = mcolors.BoundaryNorm(np.arange(len(palette) + 1) - 0.5, cmap.N)
+    artists = []
+    for grid, (x0, y0, x1, y1) in clusters:
+        if renderer == 'pcolormesh':
+            artists.append(ax.pcolormesh(np.arange(x0, x1 + 2), np.arange(y0, y1 + 2), grid, cmap=cmap, norm=norm, shading='auto'))
+        else:
+            artists.append(ax.imshow(palette[grid], extent=(x0, x1 + 1, y0, y1 + 1), origin='lower', interpolation='nearest'))
+
+    if len(home_blocks):
+        with metrics.span('markers'):
+            draw_home_blocks(ax, home_blocks, star_size)
+
+    ax.set_xlim(min_x, max_x + 1)
+    ax.set_ylim(min_y, max_y + 1)
+    ax.set_aspect('equal')
+    ax.axis('off')
+
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+
+    ax.set_title("", fontsize=16, fontweight='bold', color='#ffffff')
+    ax.invert_yaxis()
+
+    return artists
+
+def contact_sheet_cell(columns, rows, max_pixels, gap=CONTACT_SHEET_GAP_PX):
+    # The largest square view, up to MAP_SIZE_PX, for which the whole sheet including its gaps fits in
+    # max_pixels: the positive root of (columns * cell + column gaps) * (rows * cell + row gaps) = max_pixels
+    column_gaps, row_gaps = gap * (columns - 1), gap * (rows - 1)
+    a, b, c = columns * rows, columns * row_gaps + rows * column_gaps, column_gaps * row_gaps - max_pixels
+    cell = int((-b + np.sqrt(b * b - 4 * a * c)) / (2 * a))
+    return min(MAP_SIZE_PX, max(MIN_CLUSTER_PX, cell))
+
+def rasterize_map(table, grid_mode='auto', crop_clusters=False):
+    if grid_mode not in GRID_MODES:
+        raise ValueError(f"Unknown grid mode '{grid_mode}', expected one of: {', '.join(GRID_MODES)}")
+
+    bounds = town_bounds(table)
+    min_x, min_y, max_x, max_y = bounds
+    if grid_mode == 'auto':
+        dense = (max_x - min_x + 1) * (max_y - min_y + 1) <= DENSE_GRID_MAX_CELLS
+        grid_mode = 'dense' if dense else 'chunked'
+    with metrics.span('rasterize', grid_mode=grid_mode):
+        if grid_mode == 'dense' and not crop_clusters:
+            return [rasterize_towns(table)], bounds
+        return rasterize_clusters(table), bounds
+
+def gentownsmap(towns, show_home_blocks=True, color_mode='random', star_size=250, renderer='imshow',
+                grid_mode='auto', crop_clusters=False, baseline=None, max_pixels=None, values=None):
+    table = towns if isinstance(towns, TownTable) else TownTable.from_json(towns)
+    if color_mode == CLAIM_CHANGES and baseline is not None:
+        table = claim_changes(baseline, table)
+    clusters, bounds = rasterize_map(table, grid_mode, crop_clusters)
+    return draw_town_map(table, clusters, bounds, show_home_blocks, color_mode, star_size, renderer, crop_clusters, max_pixels,
+                         values)
+
+def index_colors(image, palette_colors=None):
+    # An RGB image as a 'P' image, so it encodes as an 8-bit PNG: exactly when it has at most 256 colors,
+    # otherwise with the colors Agg adds antialiasing star edges snapped to the nearest of palette_colors
+    counted = image.getcolors(256)
+    if counted is not None:
+        colors = np.array([color for _, color in counted], dtype=np.uint8)
+    elif palette_colors is not None:
+        colors = np.unique(palette_colors[:, :3], axis=0)
+    else:
+        return image
+
+    pixels = np.asarray(image)
+    pack = lambda rgb: (rgb[..., 0].astype(np.int64) << 16) | (rgb[..., 1].astype(np.int64) << 8) | rgb[..., 2]
+    keys, color_keys = pack(pixels), pack(colors)
+    order = np.argsort(color_keys)
+    colors, color_keys = colors[order], color_keys[order]
+    positions = np.minimum(np.searchsorted(color_keys, keys), len(colors) - 1)
+    missing = color_keys[positions] != keys
+    if missing.any():
+        # Each distinct off-palette color is matched once, however many pixels share it
+        off_keys, inverse = np.unique(keys[missing], return_inverse=True)
+        off_colors = np.column_stack([off_keys >> 16, (off_keys >> 8) & 255, off_keys & 255])
+        distances = ((off_colors[:, None, :] - colors[None, :, :].astype(np.int64)) ** 2).sum(axis=2)
+        positions[missing] = distances.argmin(axis=1)[inverse.reshape(-1)]
+
+    indexed = Image.fromarray(positions.astype(np.uint8))
+    indexed.putpalette(colors.tobytes())
+    return indexed
+
+def encode_image(image, image_format='png', dpi=None, max_pixels=None, compression=PNG_COMPRESSION, quality=IMAGE_QUALITY):
+    # Figures are drawn by Agg at dpi and images from the pillow renderer are scaled by dpi / MAP_DPI, both
+    # capped at max_pixels; Pillow then encodes either one, without the alpha channel every map leaves opaque
+    if image_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown format '{image_format}', expected one of: {', '.join(OUTPUT_FORMATS)}")
+
+    if not isinstance(image, Image.Image):
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        width, height = image.get_size_inches()
+        dpi = dpi or image.dpi
+        if max_pixels:
+            dpi = min(dpi, np.sqrt(max_pixels / (width * height)))
+        image.set_dpi(dpi)
+        canvas = FigureCanvasAgg(image)
+        canvas.draw()
+        palette_colors = getattr(image, 'palette_colors', None)
+        image = Image.fromarray(np.asarray(canvas.buffer_rgba())).convert('RGB')
+        if image_format == 'png':
+            image = index_colors(image, palette_colors)
+    else:
+        scale = (dpi or MAP_DPI) / MAP_DPI
+        if max_pixels:
+            scale = min(scale, np.sqrt(max_pixels / (image.width * image.height)))
+        if scale != 1:
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.NEAREST)
+        if image.mode == 'RGBA':
+            image = image.convert('RGB')
+
+    buffer = io.BytesIO()
+    if image_format == 'png':
+        image.save(buffer, format='PNG', compress_level=compression)
+    elif image_format == 'webp':
+        # Flat palette maps are smallest lossless; the method trades encode time for size like a zlib level
+        image.save(buffer, format='WEBP', lossless=image.mode == 'P', quality=quality, method=round(compression * 6 / 9))
+    else:
+        image.convert('RGB').save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+def draw_town_map(table, clusters, bounds, show_home_blocks=True, color_mode='random', star_size=250, renderer='imshow',
+                  crop_clusters=False, max_pixels=None, values=None):
+    # Renders already rasterized clusters, so several color modes can share one rasterization.
+    # max_pixels bounds a pillow contact sheet before it is allocated, MAX_MAP_PIXELS without it; values are
+    # town_colors' analytics values
+    if renderer not in RENDERERS:
+        raise ValueError(f"Unknown renderer '{renderer}', expected one of: {', '.join(RENDERERS)}")
+    if crop_clusters and len(clusters) > MAX_CROP_CLUSTERS:
+        raise ValueError(f"These towns form {len(clusters)} separate clusters, more than the {MAX_CROP_CLUSTERS} "
+                         f"a cropped map can show; select fewer towns or turn crop_clusters off.")
+
+    with metrics.span('colorize'):
+        palette = build_palette(town_colors(table, color_mode, values))
+    home_blocks = table.home_blocks if show_home_blocks else table.home_blocks[:0]
+
+    if crop_clusters:
+        views = [([cluster], cluster[1], home_blocks_within(home_blocks, cluster[1])) for cluster in clusters]
+    else:
+        views = [(clusters, bounds, home_blocks)]
+
+    columns = int(np.ceil(np.sqrt(len(views))))
+    rows = -(-len(views) // columns)
+
+    if renderer == 'pillow':
+        indexed = index_palette(palette)
+        if len(views) == 1:
+            view_clusters, view_bounds, view_home_blocks = views[0]
+            return render_map_image(view_clusters, palette, view_bounds, view_home_blocks, star_size, indexed)
+
+        # Every view shares one size, chosen from the layout so the sheet fits before anything is drawn
+        gap = CONTACT_SHEET_GAP_PX
+        cell = contact_sheet_cell(columns, rows, max_pixels or MAX_MAP_PIXELS)
+        size = (columns * cell + gap * (columns - 1), rows * cell + gap * (rows - 1))
+        if indexed is not None:
+            sheet = Image.new('P', size, int(indexed[0][0]))
+            sheet.putpalette(indexed[1][:, :3].tobytes())
+        else:
+            sheet = Image.new('RGBA', size, '#1e1e1e')
+        for i, (view_clusters, view_bounds, view_home_blocks) in enumerate(views):
+            image = render_map_image(view_clusters, palette, view_bounds, view_home_blocks, star_size, indexed, cell)
+            sheet.paste(image, ((i % columns) * (cell + gap), (i // columns) * (cell + gap)))
+        return sheet
+
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(10, 10), facecolor='#1e1e1e')
+    # The background, town and star colors, which encode_image indexes a PNG against
+    indexed = index_palette(palette)
+    fig.palette_colors = None if indexed is None else indexed[1]
+    for i, (view_clusters, view_bounds, view_home_blocks) in enumerate(views):
+        ax = fig.add_subplot(rows, columns, i + 1)
+        draw_map_axes(ax, view_clusters, palette, view_bounds, renderer, view_home_blocks, star_size)
+
+    fig.tight_layout()
+
+    return fig
+
+def render_png(table, show_home_blocks, color_mode, star_size, renderer, crop_clusters=False, baseline=None, encoding=None,
+               values=None):
+    # Runs in a render process, so its spans are returned for the caller to record.
+    # encoding holds encode_image's keyword arguments, PNG at the default size without it, and values the
+    # analytics of analytics color modes when they were worked out over more towns than table
+    timings = []
+    request_timings.set(timings)
+    encoding = encoding or {}
+
+    fig = gentownsmap(table, show_home_blocks=show_home_blocks, color_mode=color_mode, star_size=star_size,
+                      renderer=renderer, crop_clusters=crop_clusters, baseline=baseline, max_pixels=encoding.get('max_pixels'),
+                      values=values)
+
+    with metrics.span('encode', renderer=renderer, format=encoding.get('image_format', 'png')):
+        image = encode_image(fig, **encoding)
+    return image, timings
+
+def render_batch_job(table, job, output_dir):
+    # A batch job from Plutonium.py --batch, run in a spawned process; it lives here so the pool can unpickle
+    # it without the script
+    clusters, bounds = rasterize_map(table, crop_clusters=job['crop_clusters'])
+
+    paths = []
+    for color_mode in job['color_modes']:
+        fig = draw_town_map(table, clusters, bounds, job['show_home_blocks'], color_mode, job['star_size'],
+                            job['renderer'], job['crop_clusters'], job['encoding']['max_pixels'])
+        path = os.path.join(output_dir, f"{job['name']}-{color_mode.replace(' ', '_')}.{job['encoding']['image_format']}")
+        with open(path, 'wb') as f:
+            f.write(encode_image(fig, **job['encoding']))
+        paths.append(path)
+
+    return paths
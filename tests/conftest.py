@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# The scripts and the plutonium package live at the repository root, which is not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from plutonium.data import TownTable
+
+def town_json(name, blocks, nation=None, residents=1):
+    # The fields TownTable.from_json reads, the way compact_town leaves an EarthMC town
+    return {
+        'name': name,
+        'nation': {'name': nation},
+        'mayor': {'name': f'{name}Mayor'},
+        'coordinates': {'townBlocks': [list(block) for block in blocks], 'homeBlock': list(blocks[0]) if blocks else None},
+        'stats': {'numTownBlocks': len(blocks), 'numResidents': residents, 'numOutlaws': 0, 'numTrusted': 0},
+        'status': {'isOpen': True, 'isOverClaimed': False, 'hasOverclaimShield': False},
+    }
+
+@pytest.fixture
+def make_table():
+    # A TownTable from (name, blocks) or (name, blocks, nation) tuples
+    def make_table(*towns):
+        return TownTable.from_json([town_json(*town) for town in towns])
+    return make_table
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from plutonium import analytics
+from plutonium.analytics import WILDERNESS, TownAnalytics, label_components, nearest_points
+
+SQUARE = [(x, y) for x in range(3) for y in range(3)]
+RING = [block for block in SQUARE if block != (1, 1)]
+
+@pytest.fixture(params=['scipy', 'numpy'])
+def backend(request, monkeypatch):
+    # Every test using this runs on scipy when it is installed and on the numpy fallbacks either way
+    if request.param == 'scipy' and analytics.cKDTree is None:
+        pytest.skip('scipy is not installed')
+    if request.param == 'numpy':
+        for name in ('coo_matrix', 'connected_components', 'cKDTree'):
+            monkeypatch.setattr(analytics, name, None)
+    return request.param
+
+def brute_force_nearest(points):
+    squared = ((points[:, None, :] - points[None, :, :]) ** 2).sum(axis=2)
+    np.fill_diagonal(squared, np.inf)
+    return np.sqrt(squared.min(axis=1))
+
+def test_perimeter_and_compactness(backend, make_table):
+    stats = TownAnalytics(make_table(('Square', SQUARE), ('Line', [(10, y) for y in range(4)]), ('Dot', [(20, 20)])))
+    assert stats.area.tolist() == [9, 4, 1]
+    assert stats.perimeter.tolist() == [12, 10, 4]
+    assert stats.compactness.tolist() == pytest.approx([1, 0.8, 1])
+    assert stats.parts.tolist() == [1, 1, 1]
+
+def test_parts_count_separate_pieces_of_one_town(backend, make_table):
+    stats = TownAnalytics(make_table(('Split', [(0, 0), (0, 1), (5, 5)]), ('Diagonal', [(10, 10), (11, 11)])))
+    assert stats.parts.tolist() == [2, 2]
+
+def test_town_inside_a_foreign_ring_is_an_enclave(backend, make_table):
+    table = make_table(('Ring', RING, 'Outer'), ('Inside', [(1, 1)], 'Inner'))
+    stats = TownAnalytics(table)
+    assert stats.enclave_of.tolist() == [WILDERNESS, table.nation_names.index('Outer')]
+    assert stats.enclaves() == [{'realm': 'Inner', 'surrounded_by': 'Outer', 'blocks': 1, 'towns': ['Inside']}]
+    assert stats.foreign_border.tolist() == [4, 4]
+    assert stats.frontier_blocks.tolist() == [4, 1]
+    assert stats.town_borders(0) == {'Inside': 4}
+    assert stats.nation_borders() == [{'nations': ['Outer', 'Inner'], 'length': 4}]
+
+def test_same_nation_towns_are_not_enclaves_or_foreign(backend, make_table):
+    stats = TownAnalytics(make_table(('Ring', RING, 'Nation'), ('Inside', [(1, 1)], 'Nation')))
+    assert stats.enclave_of.tolist() == [WILDERNESS, WILDERNESS]
+    assert stats.enclaves() == []
+    assert stats.foreign_border.tolist() == [0, 0]
+    assert stats.town_borders(1) == {'Ring': 4}
+
+def test_towns_without_a_nation_are_realms_of_their_own(backend, make_table):
+    stats = TownAnalytics(make_table(('Ring', RING), ('Inside', [(1, 1)])))
+    assert stats.enclaves() == [{'realm': 'Inside', 'surrounded_by': 'Ring', 'blocks': 1, 'towns': ['Inside']}]
+    assert stats.nation_borders() == []
+
+def test_nearest_town_by_claim_centre(backend, make_table):
+    stats = TownAnalytics(make_table(('A', [(0, 0), (2, 0)]), ('B', [(1, 3)]), ('C', [(40, 40)]), ('Empty', [])))
+    assert stats.nearest.tolist() == [1, 0, 1, -1]
+    assert stats.nearest_distance[:3] == pytest.approx([3, 3, np.hypot(39, 37)])
+    assert np.isnan(stats.nearest_distance[3])
+
+@pytest.mark.parametrize('max_radius', [analytics.NEAREST_MAX_RADIUS, 1])
+def test_nearest_points_matches_brute_force(backend, monkeypatch, max_radius):
+    # A radius of 1 leaves most points to the final comparison with every other point
+    monkeypatch.setattr(analytics, 'NEAREST_MAX_RADIUS', max_radius)
+    rng = np.random.default_rng(0)
+    points = np.concatenate([rng.normal(0, 50, (300, 2)), rng.uniform(-2000, 2000, (50, 2)), [[0, 0], [0, 0]]])
+    nearest, distance = nearest_points(points)
+    expected = brute_force_nearest(points)
+    assert distance == pytest.approx(expected)
+    assert np.hypot(*(points - points[nearest]).T) == pytest.approx(expected)
+    assert (nearest != np.arange(len(points))).all()
+
+def test_nearest_points_skips_nan_and_needs_two_points(backend):
+    nearest, distance = nearest_points(np.array([[0, 0], [np.nan, np.nan], [3, 4]]))
+    assert nearest.tolist() == [2, -1, 0]
+    assert distance[[0, 2]].tolist() == [5, 5]
+    nearest, distance = nearest_points(np.array([[1.0, 1.0]]))
+    assert nearest.tolist() == [-1] and np.isnan(distance).all()
+
+def test_label_components_joins_chains_and_keeps_isolated_nodes(backend):
+    labels = label_components(np.array([4, 3, 2, 6]), np.array([3, 2, 1, 5]), 8)
+    assert labels[1] == labels[2] == labels[3] == labels[4]
+    assert labels[5] == labels[6]
+    assert len({labels[0], labels[1], labels[5], labels[7]}) == 4
+    assert sorted(set(labels.tolist())) == [0, 1, 2, 3]
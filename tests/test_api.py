@@ -0,0 +1,91 @@
+import importlib.util
+import os
+import sys
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+pytest.importorskip('flask')
+
+API_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'PlutoniumAPI[Bata].py')
+MAP_REQUEST = {'nation_names': 'Nation', 'color_mode': 'random'}
+
+@pytest.fixture(scope='module')
+def api_module():
+    # The API is a script with brackets in its name, so it is loaded from its path rather than imported
+    spec = importlib.util.spec_from_file_location('plutonium_api', API_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    yield module
+    del sys.modules[spec.name]
+
+@pytest.fixture
+def api(api_module, monkeypatch):
+    # No background world refresh, and an empty map cache for every test
+    monkeypatch.setattr(api_module, 'WORLD_REFRESH_INTERVAL', 0)
+    api_module.map_cache.clear()
+    return api_module
+
+def test_identical_concurrent_requests_share_one_render(api, monkeypatch):
+    started, waiting = threading.Event(), threading.Event()
+    renders = []
+
+    class WatchedFuture(Future):
+        # Only requests that found a render already running wait on its Future
+        def result(self, timeout=None):
+            waiting.set()
+            return super().result(timeout)
+
+    def render_map_png(**options):
+        renders.append(options)
+        started.set()
+        assert waiting.wait(5)
+        return b'map'
+
+    monkeypatch.setattr(api, 'Future', WatchedFuture)
+    monkeypatch.setattr(api, 'render_map_png', render_map_png)
+
+    responses = []
+    def post():
+        responses.append(api.app.test_client().post('/generate_map', json=MAP_REQUEST))
+
+    first = threading.Thread(target=post)
+    first.start()
+    assert started.wait(5)
+    second = threading.Thread(target=post)
+    second.start()
+    first.join(5)
+    second.join(5)
+
+    assert len(renders) == 1
+    assert [response.status_code for response in responses] == [200, 200]
+    assert [response.data for response in responses] == [b'map', b'map']
+    assert responses[0].headers['ETag'] == responses[1].headers['ETag']
+    assert not api.map_renders
+
+def test_a_failed_render_is_not_cached(api, monkeypatch):
+    def render_map_png(**options):
+        raise api.MapRequestError("No valid town data found.")
+
+    monkeypatch.setattr(api, 'render_map_png', render_map_png)
+    response = api.app.test_client().post('/generate_map', json=MAP_REQUEST)
+    assert response.status_code == 400
+    assert not api.map_renders and api.map_cache.stats()['size'] == 0
+
+def test_a_repeat_request_with_the_etag_is_not_modified(api, monkeypatch):
+    renders = []
+    monkeypatch.setattr(api, 'render_map_png', lambda **options: renders.append(options) or b'map')
+    client = api.app.test_client()
+
+    response = client.post('/generate_map', json=MAP_REQUEST)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    repeat = client.post('/generate_map', json=MAP_REQUEST, headers={'If-None-Match': etag})
+    assert repeat.status_code == 304
+    assert repeat.data == b''
+    assert repeat.headers['ETag'] == etag
+    assert client.post('/generate_map', json=MAP_REQUEST, headers={'If-None-Match': '"stale"'}).data == b'map'
+    assert len(renders) == 1
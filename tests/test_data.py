@@ -0,0 +1,171 @@
+import types
+
+import numpy as np
+import pytest
+
+from plutonium import data
+from plutonium.data import BlockIndex, HistoryStore, TownTable, TTLCache, claim_changes
+
+def test_offsets_index_each_towns_blocks(make_table):
+    table = make_table(('A', [(0, 0), (1, 0)]), ('B', []), ('C', [(5, 5), (5, 6), (6, 6)]))
+    assert table.offsets.tolist() == [0, 2, 2, 5]
+    assert table.town_blocks(0).tolist() == [[0, 0], [1, 0]]
+    assert table.town_blocks(1).shape == (0, 2)
+    assert table.town_blocks(2).tolist() == [[5, 5], [5, 6], [6, 6]]
+    assert table.town_ids.tolist() == [0, 0, 2, 2, 2]
+
+def test_take_rebuilds_offsets_for_reordered_and_repeated_towns(make_table):
+    table = make_table(('A', [(0, 0), (1, 0)], 'N'), ('B', []), ('C', [(5, 5), (5, 6), (6, 6)]))
+    taken = table.take([2, 1, 0, 2])
+    assert list(taken.names) == ['C', 'B', 'A', 'C']
+    assert taken.offsets.tolist() == [0, 3, 3, 5, 8]
+    assert taken.town_blocks(2).tolist() == [[0, 0], [1, 0]]
+    assert taken.town_blocks(3).tolist() == table.town_blocks(2).tolist()
+    assert taken.stats['numTownBlocks'].tolist() == [3, 0, 2, 3]
+    assert taken.nations == [None, None, 'N', None]
+
+def test_take_nothing_is_an_empty_table(make_table):
+    taken = make_table(('A', [(0, 0)])).take([])
+    assert len(taken) == 0
+    assert taken.offsets.tolist() == [0]
+    assert taken.blocks.shape == (0, 2)
+
+def test_concat_remaps_nation_codes(make_table):
+    first = make_table(('A', [(0, 0)], 'North'), ('B', [(1, 1)]))
+    second = make_table(('C', [(2, 2)], 'South'), ('D', [(3, 3), (3, 4)], 'North'))
+    table = TownTable.concat([first, second])
+    assert table.nations == ['North', None, 'South', 'North']
+    assert table.offsets.tolist() == [0, 1, 2, 3, 5]
+    assert table.town_blocks(3).tolist() == [[3, 3], [3, 4]]
+
+def test_select_matches_nations_and_towns_case_insensitively(make_table):
+    table = make_table(('A', [(0, 0)], 'North'), ('B', [(1, 1)], 'South'), ('C', [(2, 2)]))
+    assert list(table.select(['north'], ['c']).names) == ['A', 'C']
+    assert len(table.select()) == 0
+
+def test_home_blocks_are_nan_for_towns_without_one(make_table):
+    table = make_table(('A', [(4, 2)]), ('B', []))
+    assert table.home_blocks[0].tolist() == [4, 2]
+    assert np.isnan(table.home_blocks[1]).all()
+
+@pytest.fixture(params=['direct', 'sorted'])
+def block_index(request, monkeypatch, make_table):
+    # Both lookups: the chunk-keyed direct table, and the sorted search worlds too sparse for it fall back to
+    if request.param == 'sorted':
+        monkeypatch.setattr(data, 'INDEX_TABLE_MAX_CELLS', 0)
+    table = make_table(('A', [(0, 0), (1, 0), (-1, -1)]), ('B', []), ('C', [(15, 15), (16, 16), (-17, 40)]))
+    index = BlockIndex(table)
+    assert (index.chunk_cells is not None) == (request.param == 'direct')
+    return index
+
+def test_block_index_finds_the_owner_of_claimed_blocks(block_index):
+    assert block_index.towns_at([0, 1, -1, 15, 16, -17], [0, 0, -1, 15, 16, 40]).tolist() == [0, 0, 0, 2, 2, 2]
+    assert block_index.town_at(-17, 40) == 2
+
+def test_block_index_misses_unclaimed_and_out_of_range_blocks(block_index):
+    assert block_index.towns_at([2, 0, 15, 10 ** 6, -10 ** 6], [0, 1, 16, 0, 0]).tolist() == [-1] * 5
+    assert block_index.town_at(16, 15) == -1
+    assert block_index.town_at(-(2 ** 31), 2 ** 31 - 1) == -1
+
+def test_block_index_matches_every_block_of_a_random_world(make_table):
+    rng = np.random.default_rng(0)
+    blocks = np.unique(rng.integers(-500, 500, (3000, 2)), axis=0)
+    owners = rng.integers(0, 50, len(blocks))
+    table = make_table(*((f'T{i}', blocks[owners == i].tolist()) for i in range(50)))
+    index = BlockIndex(table)
+    assert np.array_equal(index.towns_at(table.blocks[:, 0], table.blocks[:, 1]), table.town_ids)
+    x, y = table.blocks[100]
+    assert index.town_at(x, y) == table.town_ids[100]
+
+def test_towns_in_rect_checks_blocks_of_partly_overlapping_towns(block_index):
+    assert block_index.towns_in_rect(0, 0, 15, 15).tolist() == [0, 2]
+    assert block_index.towns_in_rect(2, 1, 14, 14).tolist() == []
+    assert block_index.towns_in_rect(-20, -20, 20, 50).tolist() == [0, 2]
+
+def town_states(table):
+    return {name: (sorted(map(tuple, table.town_blocks(i).tolist())), table.nations[i], int(table.stats['numResidents'][i]))
+            for i, name in enumerate(table.names)}
+
+def history_states(make_table):
+    # Each state changes the one before: a claim grows, a block moves, a town leaves, joins or changes nation
+    return [
+        make_table(('A', [(0, 0)], 'N'), ('B', [(5, 5), (5, 6)]), ('C', [(9, 9)], 'N')),
+        make_table(('A', [(0, 0), (0, 1)], 'N'), ('B', [(5, 5), (5, 6)]), ('C', [(9, 9)], 'N')),
+        make_table(('A', [(0, 0), (0, 1)], 'N'), ('B', [(5, 5), (6, 6)]), ('C', [(9, 9)], 'N'), ('D', [(2, 2)])),
+        make_table(('A', [(0, 0), (0, 1)], 'M'), ('D', [(2, 2)])),
+        make_table(('A', [(0, 0), (0, 1)], 'M', 4), ('D', [(2, 2)]), ('C', [(9, 9)])),
+    ]
+
+def test_history_round_trips_keyframes_and_deltas(tmp_path, make_table):
+    states = history_states(make_table)
+    history = HistoryStore(str(tmp_path), keyframe_every=3)
+    for i, table in enumerate(states):
+        history.append(table, 1000 + 100 * i)
+    assert [entry['kind'] for entry in history.entries] == ['key', 'delta', 'delta', 'key', 'delta']
+    assert history.entries[3]['towns'] == 2
+    assert history.entries[4]['changed'] == 2
+
+    # A fresh store reads everything back from disk, replaying deltas onto their keyframe
+    reopened = HistoryStore(str(tmp_path))
+    for i, table in enumerate(states):
+        assert town_states(reopened.load(1000 + 100 * i + 50)) == town_states(table)
+    assert reopened.load(999) is None
+
+def test_history_delta_records_removed_towns(tmp_path, make_table):
+    states = history_states(make_table)
+    history = HistoryStore(str(tmp_path), keyframe_every=10)
+    for i, table in enumerate(states):
+        history.append(table, 1000 + 100 * i)
+    assert history.entries[3]['removed'] == ['B', 'C']
+    assert sorted(history.load(1300).names) == ['A', 'D']
+
+def test_history_rejects_entries_that_are_not_newer(tmp_path, make_table):
+    history = HistoryStore(str(tmp_path))
+    table = make_table(('A', [(0, 0)]))
+    history.append(table, 1000)
+    with pytest.raises(ValueError):
+        history.append(table, 1000)
+
+def test_claim_changes_splits_kept_gained_and_lost_blocks(make_table):
+    before = make_table(('A', [(0, 0), (0, 1)]), ('B', [(5, 5)]))
+    after = make_table(('A', [(0, 0), (1, 0)]), ('C', []))
+    changes = claim_changes(before, after)
+    assert [sorted(map(tuple, changes.town_blocks(i).tolist())) for i in range(3)] == [[(0, 0)], [(1, 0)], [(0, 1), (5, 5)]]
+    assert list(changes.names[3:]) == ['A', 'C']
+    assert len(changes.town_blocks(3)) == 0
+
+@pytest.fixture
+def clock(monkeypatch):
+    # TTLCache's time.monotonic, moved on by hand
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(data, 'time', types.SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+def test_ttl_cache_expires_entries_after_the_ttl(clock):
+    cache = TTLCache(ttl=60, max_size=10)
+    cache.set('a', 1)
+    clock.now += 60
+    assert cache.get('a') == 1
+    clock.now += 1
+    assert cache.get('a') is None
+    assert 'a' not in cache.entries
+    assert cache.stats() == {'size': 0, 'hits': 1, 'misses': 1, 'evictions': 0, 'hit_rate': 0.5}
+
+def test_ttl_cache_set_restarts_the_ttl(clock):
+    cache = TTLCache(ttl=60, max_size=10)
+    cache.set('a', 1)
+    clock.now += 50
+    cache.set('a', 2)
+    clock.now += 50
+    assert cache.get('a') == 2
+
+def test_ttl_cache_evicts_the_least_recently_used_entry(clock):
+    cache = TTLCache(ttl=60, max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert cache.stats()['evictions'] == 1
+    assert cache.stats()['size'] == 2
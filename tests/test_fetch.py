@@ -0,0 +1,203 @@
+import asyncio
+import importlib.util
+import json
+import sys
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from plutonium import fetch
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+
+class ScriptedServer:
+    # Answers each POST with the next (status, body) in responses, repeating the last one once they run out
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                status, body = server.responses[min(server.requests, len(server.responses) - 1)]
+                server.requests += 1
+                body = body if isinstance(body, bytes) else json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}/towns'
+        threading.Thread(target=self.httpd.serve_forever, args=(0.01,), daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+@pytest.fixture
+def scripted_server():
+    servers = []
+
+    def start(*responses):
+        servers.append(ScriptedServer(responses))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+# One town as the EarthMC API sends it, with fields compact_town drops
+TOWN = {
+    'name': 'Town', 'uuid': 'town-uuid', 'board': 'Hello', 'nation': {'name': 'Nation', 'uuid': 'nation-uuid'},
+    'mayor': {'name': 'Mayor', 'uuid': 'mayor-uuid'},
+    'coordinates': {'townBlocks': [[1, 2], [1, 3]], 'homeBlock': [1, 2], 'spawn': {'x': 16.5}},
+    'stats': {'numTownBlocks': 2, 'numResidents': 3, 'numOutlaws': 0, 'numTrusted': 1, 'balance': 12.5},
+    'status': {'isOpen': True, 'isOverClaimed': False, 'hasOverclaimShield': False, 'isPublic': True},
+}
+
+streaming = pytest.mark.parametrize('stream', [
+    pytest.param(True, marks=pytest.mark.skipif(fetch.ijson is None, reason='ijson is not installed')),
+    False,
+])
+json_modules = pytest.mark.parametrize('use_orjson', [
+    pytest.param(True, marks=pytest.mark.skipif(fetch.orjson is None, reason='orjson is not installed')),
+    False,
+])
+
+def post(url, parse=None, max_retries=3):
+    async def run():
+        client = fetch.EarthMCClient(max_retries=max_retries, backoff=0.001, max_backoff=0.001)
+        try:
+            return await client.post(url, ['Town'], parse)
+        finally:
+            await client.close()
+    return asyncio.run(run())
+
+def test_token_bucket_allows_a_burst_then_paces_to_the_rate(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(fetch, 'time', clock)
+    monkeypatch.setattr(asyncio, 'sleep', clock.sleep)
+    bucket = fetch.TokenBucket(rate=10, capacity=3)
+
+    async def acquire(count):
+        for _ in range(count):
+            await bucket.acquire()
+
+    asyncio.run(acquire(3))
+    assert clock.now == 0
+    asyncio.run(acquire(2))
+    assert clock.now == pytest.approx(0.2)
+
+def test_token_bucket_refills_up_to_capacity_only(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(fetch, 'time', clock)
+    monkeypatch.setattr(asyncio, 'sleep', clock.sleep)
+    bucket = fetch.TokenBucket(rate=10, capacity=2)
+
+    clock.now = 60
+    asyncio.run(bucket.acquire())
+    asyncio.run(bucket.acquire())
+    assert clock.now == 60
+    asyncio.run(bucket.acquire())
+    assert clock.now == pytest.approx(60.1)
+
+def test_retry_delay_honours_retry_after_and_caps_backoff():
+    client = fetch.EarthMCClient(backoff=1, max_backoff=4)
+    assert all(0 <= client.retry_delay(attempt) <= 4 for attempt in range(10))
+    assert client.retry_delay(0, '7') >= 7
+    assert client.retry_delay(0, 'soon') <= 1
+
+def test_request_retries_server_errors_and_rate_limits(scripted_server):
+    server = scripted_server((503, {}), (429, {}), (200, [{'name': 'Town'}]))
+    assert post(server.url) == [{'name': 'Town'}]
+    assert server.requests == 3
+
+def test_request_does_not_retry_client_errors(scripted_server):
+    server = scripted_server((404, {}))
+    with pytest.raises(fetch.EarthMCAPIError, match='404'):
+        post(server.url)
+    assert server.requests == 1
+
+def test_request_gives_up_after_max_retries(scripted_server):
+    server = scripted_server((500, {}))
+    with pytest.raises(fetch.EarthMCAPIError, match='500'):
+        post(server.url, max_retries=2)
+    assert server.requests == 3
+
+@json_modules
+def test_loads_json_with_and_without_orjson(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(fetch, 'orjson', None)
+    assert fetch.loads_json(json.dumps([TOWN]).encode()) == [TOWN]
+
+@streaming
+@json_modules
+def test_read_towns_compacts_towns_on_every_parser(monkeypatch, scripted_server, stream, use_orjson):
+    monkeypatch.setattr(fetch, 'STREAM_TOWNS', stream)
+    if not use_orjson:
+        monkeypatch.setattr(fetch, 'orjson', None)
+    server = scripted_server((200, [TOWN, dict(TOWN, name='Other')]))
+    towns = post(server.url, fetch.read_towns)
+
+    assert [town['name'] for town in towns] == ['Town', 'Other']
+    assert towns[0]['coordinates']['townBlocks'].tolist() == [[1, 2], [1, 3]]
+    assert towns[0]['stats'] == {'numTownBlocks': 2, 'numResidents': 3, 'numOutlaws': 0, 'numTrusted': 1}
+    assert 'uuid' not in towns[0] and 'spawn' not in towns[0]['coordinates']
+
+def load_fetch_with_ijson(monkeypatch, backend):
+    # A fresh copy of plutonium.fetch that imports a stand-in ijson on the given backend, recording how it parses
+    fake_ijson = types.ModuleType('ijson')
+    fake_ijson.backend = backend
+    fake_ijson.JSONError = ValueError
+    parsed_with = []
+
+    async def items_async(content, prefix, use_float=False):
+        parsed_with.append('ijson')
+        yield json.loads(await content.read())[0]
+
+    fake_ijson.items_async = items_async
+    monkeypatch.setitem(sys.modules, 'ijson', fake_ijson)
+    spec = importlib.util.spec_from_file_location('plutonium.fetch_under_test', fetch.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    loads_json = module.loads_json
+    module.loads_json = lambda body: parsed_with.append('loads_json') or loads_json(body)
+    return module, parsed_with
+
+@pytest.mark.parametrize('backend, parser', [('yajl2_c', 'ijson'), ('python', 'loads_json'), ('yajl2', 'loads_json')])
+def test_towns_only_stream_with_ijsons_c_backend(monkeypatch, scripted_server, backend, parser):
+    module, parsed_with = load_fetch_with_ijson(monkeypatch, backend)
+    server = scripted_server((200, [TOWN]))
+    towns = post(server.url, module.read_towns)
+    assert [town['name'] for town in towns] == ['Town']
+    assert parsed_with == [parser]
+
+@streaming
+@pytest.mark.parametrize('body', [b'<html>Bad Gateway</html>', b'[{"name": "Town", "coordinates": {"townBlocks": [[1,'])
+def test_undecodable_bodies_are_retried_then_raise_earthmc_errors(monkeypatch, scripted_server, stream, body):
+    monkeypatch.setattr(fetch, 'STREAM_TOWNS', stream)
+    server = scripted_server((200, body))
+    with pytest.raises(fetch.EarthMCAPIError):
+        post(server.url, fetch.read_towns, max_retries=1)
+    assert server.requests == 2
+
+def test_a_body_that_decodes_on_retry_is_returned(scripted_server):
+    server = scripted_server((200, b'{"truncated": '), (200, [TOWN]))
+    assert post(server.url) == [TOWN]
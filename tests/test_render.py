@@ -0,0 +1,116 @@
+import io
+
+import matplotlib.colors as mcolors
+import numpy as np
+import pytest
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+
+from plutonium.render import (analytics_values, downsample_max, encode_image, gentownsmap, index_colors, rasterize_clusters,
+                              rasterize_map, rasterize_towns, town_colors)
+
+RING = [(x, y) for x in range(3) for y in range(3) if (x, y) != (1, 1)]
+
+@pytest.fixture
+def spread_towns(make_table):
+    # Towns across chunk edges and negative coordinates, in clusters far enough apart to rasterize separately
+    return make_table(('Edge', [(x, y) for x in range(-5, 6) for y in range(-3, 2)], 'A'),
+                      ('Corner', [(6, 2), (7, 2), (7, 3), (70, 3)], 'A'),
+                      ('Far', [(-200, 150), (-199, 150), (-199, 151)], 'B'),
+                      ('Dot', [(300, -90)]))
+
+def paste_clusters(clusters, bounds):
+    min_x, min_y, max_x, max_y = bounds
+    grid = np.zeros((max_y - min_y + 1, max_x - min_x + 1), dtype=np.int32)
+    for cluster, (left, top, right, bottom) in clusters:
+        assert cluster.any(axis=0)[[0, -1]].all() and cluster.any(axis=1)[[0, -1]].all()
+        view = grid[top - min_y:bottom - min_y + 1, left - min_x:right - min_x + 1]
+        assert not view.any()
+        view[:] = cluster
+    return grid
+
+def test_downsample_max_keeps_the_highest_town_in_each_square():
+    region = np.zeros((4, 4), dtype=np.int32)
+    region[0, 1] = 3
+    region[1, 0] = 5
+    region[3, 3] = 1
+    assert downsample_max(region, 2).tolist() == [[5, 0], [0, 1]]
+
+def test_downsample_max_keeps_single_block_towns_visible():
+    region = np.zeros((256, 256), dtype=np.int32)
+    region[17, 200] = 7
+    cells = downsample_max(region, 64)
+    assert cells.shape == (4, 4)
+    assert cells[0, 3] == 7
+    assert np.count_nonzero(cells) == 1
+
+def test_downsample_max_pads_partial_squares_with_background():
+    region = np.arange(1, 16, dtype=np.int32).reshape(3, 5)
+    cells = downsample_max(region, 2)
+    assert cells.shape == (2, 3)
+    assert cells.tolist() == [[7, 9, 10], [12, 14, 15]]
+
+def test_downsample_max_at_scale_one_is_unchanged():
+    region = np.arange(6, dtype=np.int32).reshape(2, 3)
+    assert np.array_equal(downsample_max(region, 1), region)
+
+def test_analytics_colors_of_selected_towns_count_their_neighbours(make_table):
+    world = make_table(('Ring', RING, 'Outer'), ('Inside', [(1, 1)], 'Inner'))
+    inner = world.select(nation_names=['Inner'])
+    red, grey = mcolors.to_rgba('red'), mcolors.to_rgba('grey')
+
+    assert town_colors(inner, 'Enclaves').tolist() == [list(grey)]
+    values = analytics_values(world, 'Enclaves', [1])
+    assert town_colors(inner, 'Enclaves', values).tolist() == [list(red)]
+    assert analytics_values(world, 'Foreign Border', [1]).tolist() == [4]
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 64])
+def test_chunked_rasterization_matches_dense(spread_towns, chunk_size):
+    dense, bounds = rasterize_towns(spread_towns)
+    assert np.array_equal(paste_clusters(rasterize_clusters(spread_towns, chunk_size), bounds), dense)
+
+def test_chunked_maps_are_pixel_identical_to_dense(spread_towns):
+    clusters, bounds = rasterize_map(spread_towns, 'chunked')
+    assert len(clusters) > 1
+    assert np.array_equal(paste_clusters(clusters, bounds), rasterize_map(spread_towns, 'dense')[0][0][0])
+
+    images = [np.asarray(gentownsmap(spread_towns, color_mode='numResidents', renderer='pillow', grid_mode=grid_mode).convert('RGB'))
+              for grid_mode in ('dense', 'chunked')]
+    assert np.array_equal(*images)
+
+@pytest.mark.parametrize('renderer', ['imshow', 'pcolormesh', 'pillow'])
+def test_pngs_are_indexed_and_match_the_rgb_render(spread_towns, renderer):
+    fig = gentownsmap(spread_towns, show_home_blocks=False, color_mode='numResidents', renderer=renderer)
+    png = Image.open(io.BytesIO(encode_image(fig)))
+    assert png.format == 'PNG' and png.mode == 'P'
+
+    if renderer == 'pillow':
+        rgb = np.asarray(fig.convert('RGB'))
+    else:
+        # encode_image drew the figure at its own dpi, so drawing it again gives the same pixels
+        canvas = FigureCanvasAgg(fig)
+        canvas.draw()
+        rgb = np.asarray(canvas.buffer_rgba())[..., :3]
+    assert np.array_equal(np.asarray(png.convert('RGB')), rgb)
+
+def test_index_colors_is_exact_up_to_256_colors():
+    pixels = np.arange(256 * 3, dtype=np.uint8).reshape(16, 16, 3)
+    indexed = index_colors(Image.fromarray(pixels))
+    assert indexed.mode == 'P'
+    assert np.array_equal(np.asarray(indexed.convert('RGB')), pixels)
+
+def test_index_colors_snaps_extra_colors_to_the_palette():
+    palette_colors = np.array([[0, 0, 0, 255], [200, 0, 0, 255], [0, 0, 200, 255]], dtype=np.uint8)
+    # More colors than an 8-bit palette holds, as Agg's antialiased star edges can add
+    pixels = np.random.default_rng(0).integers(0, 256, (32, 32, 3), dtype=np.uint8)
+    pixels[:8] = [200, 0, 0]
+    assert Image.fromarray(pixels).getcolors(256) is None
+
+    indexed = index_colors(Image.fromarray(pixels), palette_colors)
+    assert indexed.mode == 'P'
+    result = np.asarray(indexed.convert('RGB')).reshape(-1, 3).astype(int)
+    assert {tuple(color) for color in result} <= {tuple(color) for color in palette_colors[:, :3]}
+    # Each pixel gets a nearest palette color, whichever one of a tie that is
+    pixels = pixels.reshape(-1, 3).astype(int)
+    nearest = ((pixels[:, None, :] - palette_colors[None, :, :3].astype(int)) ** 2).sum(axis=2).min(axis=1)
+    assert np.array_equal(((pixels - result) ** 2).sum(axis=1), nearest)